@@ -1,6 +1,9 @@
 export const indexerMap: Map<string, string> = new Map<string, string>([
   ["llm_tree_idx", "LLM + Tree"],
   ["inverted_idx", "Inverted Index"],
+  ["bm25_idx", "Inverted Index (BM25)"],
+  ["w2v_idx", "Word2Vec + Annoy"],
+  ["hybrid_idx", "Hybrid (BM25 + LLM)"],
 ]);
 
 export interface Proposal {
@@ -1,21 +1,55 @@
 import os
 from contextlib import asynccontextmanager
+from typing import Annotated
 
 import uvicorn
 from dotenv import dotenv_values
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, Query, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
 
 from src.pipeline import ApiModel, Indexer, IndexerPipeline, LocalModel, RAGPipeline
-from src.scrapper import scrap
-from src.utils import load, parse_document_content
+from src.registry import REGISTRY
+from src.scrapper import DOCS_URL_PREFIX, scrap_async
+from src.timing import TIMER
+from src.workers import PoolOverloadedError, WorkerPool
 
 DATA_PATH = os.path.join("./data/scrapped/class_data_function__1_1")
 CONFIG = dotenv_values(".env")
 
-PIPELINE = IndexerPipeline()
-RAG_PIPELINE = RAGPipeline()
+VECTOR_BACKEND = CONFIG.get("VECTOR_BACKEND") or "exact"
+
+PIPELINE = IndexerPipeline(
+    VECTOR_BACKEND,  # type: ignore
+    w2v_search_k=int(CONFIG.get("W2V_SEARCH_K") or -1),
+    w2v_prefault=bool(CONFIG.get("W2V_PREFAULT")),
+    hybrid_fusion=CONFIG.get("HYBRID_FUSION") or "rrf",  # type: ignore
+    hybrid_budget_ms=float(CONFIG.get("HYBRID_BUDGET_MS") or 0) or None,
+)
+RAG_PIPELINE = RAGPipeline(
+    PIPELINE,
+    local_preload=[
+        model.strip()
+        for model in (CONFIG.get("LOCAL_MODELS_PRELOAD") or "").split(",")
+        if model.strip()
+    ],  # type: ignore
+    local_memory_budget_mb=float(CONFIG.get("LOCAL_MODELS_MEMORY_MB") or 0) or None,
+    local_quantize=bool(CONFIG.get("LOCAL_MODELS_INT8")),
+    local_max_batch_size=int(CONFIG.get("LOCAL_BATCH_SIZE") or 8),
+    local_batch_wait_ms=float(CONFIG.get("LOCAL_BATCH_WAIT_MS") or 10),
+    context_tokens=int(CONFIG.get("RAG_CONTEXT_TOKENS") or 3000),
+)
+
+# Components are loaded on first use unless preloading is enabled
+if CONFIG.get("PRELOAD"):
+    REGISTRY.preload()
+
+# Search and retrieval run here, so a slow query does not block the event loop
+WORKER_POOL = WorkerPool(
+    max_workers=int(CONFIG.get("POOL_WORKERS") or 0) or None,
+    max_pending=int(CONFIG.get("POOL_MAX_PENDING") or 0) or None,
+)
 
 app = FastAPI()
 
@@ -24,7 +58,11 @@ app = FastAPI()
 async def lifespan(app: FastAPI):
     if not os.path.exists(DATA_PATH):
         print(f"Data path '{DATA_PATH}' does not exist. Creating...")
-        scrap()
+        await scrap_async(
+            base_url=CONFIG.get("SCRAP_BASE_URL") or DOCS_URL_PREFIX,
+            concurrency=int(CONFIG.get("SCRAP_CONCURRENCY") or 8),
+            rate_limit=float(CONFIG.get("SCRAP_RATE_LIMIT") or 0) or None,
+        )
 
     if not os.path.exists(DATA_PATH):
         raise RuntimeError(
@@ -43,32 +81,82 @@ app.add_middleware(
 
 
 @app.get("/search")
-async def search(query: str, indexer: Indexer):
+async def search(query: str, indexer: Indexer, debug: bool = False):
+    # With `debug`, the milliseconds spent in every stage are returned too (empty
+    # for cached results)
     try:
-        corrected_query, proposals = PIPELINE.index(query, indexer)
+        (corrected_query, proposals), timings = await WORKER_POOL.run(
+            TIMER.traced, PIPELINE.index, query, indexer
+        )
+    except PoolOverloadedError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(exc)
+        ) from exc
     except RuntimeError as exc:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail=f"Indexer '{indexer}' not found"
         ) from exc
-    return {
+    response = {
         "corrected": corrected_query,
         "proposals": [{"document": doc, "score": score} for doc, score in proposals],
     }
+    if debug:
+        response["timings"] = timings
+    return response
+
+
+class BatchSearchRequest(BaseModel):
+    queries: list[str]
+    indexer: Indexer
+    k: int = Field(10, gt=0)
+
+
+@app.post("/search/batch")
+async def search_batch(request: BatchSearchRequest, debug: bool = False):
+    try:
+        results, timings = await WORKER_POOL.run(
+            TIMER.traced,
+            PIPELINE.index_many,
+            request.queries,
+            request.indexer,
+            k=request.k,
+        )
+    except PoolOverloadedError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(exc)
+        ) from exc
+    except RuntimeError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Indexer '{request.indexer}' not found",
+        ) from exc
+    responses = [
+        {
+            "corrected": corrected_query,
+            "proposals": [{"document": doc, "score": score} for doc, score in proposals],
+        }
+        for corrected_query, proposals in results
+    ]
+    if debug:
+        return {"results": responses, "timings": timings}
+    return responses
 
 
 @app.get("/document")
 async def document_page(name: str):
+    # The document store is loaded (packed and hashed on the first call) and read in
+    # the worker pool as well
     try:
-        content = load(os.path.join(DATA_PATH, f"{name}.txt"))
+        document = await WORKER_POOL.run(lambda: PIPELINE.documents.get_parsed(name))
+    except PoolOverloadedError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(exc)
+        ) from exc
     except FileNotFoundError as e:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail=f"Document '{name}' not found"
         ) from e
-    return {
-        "name": name,
-        **parse_document_content(content),
-        "content": content,
-    }
+    return {"name": name, **document}
 
 
 @app.get("/indexers")
@@ -76,18 +164,53 @@ async def get_indexers_list():
     return PIPELINE.available_indexers
 
 
+@app.get("/cache")
+async def get_cache_stats():
+    return PIPELINE.cache_stats()
+
+
+@app.get("/components")
+async def get_components():
+    return REGISTRY.report()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Stage latency histograms, in the Prometheus text format
+    return PlainTextResponse(
+        TIMER.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.get("/models")
 async def get_llm_list():
     return RAG_PIPELINE.available_models
 
 
+@app.get("/models/local")
+async def get_local_models_stats():
+    return RAG_PIPELINE.local_stats()
+
+
 @app.get("/chat")
-async def chat(prompt: str, k: int, model: ApiModel | LocalModel, indexer: Indexer):
+async def chat(
+    prompt: str,
+    k: Annotated[int, Query(gt=0)],
+    model: ApiModel | LocalModel,
+    indexer: Indexer,
+):
     try:
+        scored_docs = await WORKER_POOL.run(
+            RAG_PIPELINE.retrieve, prompt, model, k, indexer
+        )
         return StreamingResponse(
-            RAG_PIPELINE.request(prompt, model, k, indexer),
+            RAG_PIPELINE.generate(prompt, model, scored_docs),
             media_type="text/event-stream",
         )
+    except PoolOverloadedError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(exc)
+        ) from exc
     except RuntimeError as exc:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc)
@@ -100,5 +223,8 @@ if __name__ == "__main__":
         host="0.0.0.0",
         port=int(CONFIG["BACKEND_PORT"] or 8000),
         reload=bool(CONFIG["DEBUG"]),
+        # Query expansion and spell correction hold the GIL, processes scale them
+        # with cores
+        workers=int(CONFIG.get("SERVER_WORKERS") or 1),
         log_level="info" if bool(CONFIG["DEBUG"]) else "warning",
     )
@@ -0,0 +1,79 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from src.benchmarks.metrics import ndcg_at_k, recall_at_k, reciprocal_rank_at_k
+from src.hybrid import HybridSearch
+from src.pipeline import IndexerPipeline
+from src.utils import from_current_file, load_json
+
+QUERIES_PATH = from_current_file("../data/evaluation/queries.json")
+
+
+def run_benchmark(k: int, repeat: int, budgets: list[float | None]):
+    queries = list(load_json(QUERIES_PATH).values())
+    # Results are not cached, every run searches
+    pipeline = IndexerPipeline(cache_size=0)
+    pipeline.index(queries[0]["query"], "hybrid_idx", k=k)  # loads all indexes
+
+    print(f"{len(queries)} queries, k={k}\n")
+    print(
+        f"{'indexer':<32} {'p50, ms':>8} {'p95, ms':>8} {'recall@k':>9} "
+        f"{'MRR@k':>6} {'nDCG@k':>7} {'partial':>8}"
+    )
+
+    def report(name: str, indexer: str):
+        timings, recalls, ranks, ndcgs = [], [], [], []
+        skipped = sum(pipeline.hybrid.skipped.values())
+        for query in queries:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                _, scored_docs = pipeline.index(query["query"], indexer, k=k)  # type: ignore
+                timings.append(time.perf_counter() - start)
+            predicted = [document for document, _ in scored_docs]
+            recalls.append(recall_at_k(query["ground_truths"], predicted, k))
+            ranks.append(reciprocal_rank_at_k(query["ground_truths"], predicted, k))
+            ndcgs.append(ndcg_at_k(query["ground_truths"], predicted, k))
+        p95 = statistics.quantiles(timings, n=20)[-1] if len(timings) > 1 else timings[0]
+        print(
+            f"{name:<32} {statistics.median(timings) * 1e3:>8.2f} {p95 * 1e3:>8.2f} "
+            f"{statistics.mean(recalls):>9.3f} {statistics.mean(ranks):>6.3f} "
+            f"{statistics.mean(ndcgs):>7.3f} "
+            f"{sum(pipeline.hybrid.skipped.values()) - skipped:>8}"
+        )
+
+    report("bm25_idx", "bm25_idx")
+    report("llm_tree_idx", "llm_tree_idx")
+    for fusion in ("rrf", "blend"):
+        for budget in budgets:
+            pipeline.hybrid = HybridSearch(fusion, latency_budget_ms=budget)
+            report(f"hybrid_idx ({fusion}, budget={budget})", "hybrid_idx")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare quality and latency of hybrid search with the indexers it "
+        "fuses, on the evaluation queries"
+    )
+    parser.add_argument("-k", type=int, default=10, help="documents to retrieve")
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=5, help="runs per query (latency only)"
+    )
+    parser.add_argument(
+        "--budgets",
+        type=float,
+        nargs="+",
+        default=[0, 5],
+        help="hybrid latency budgets, ms (0 is no budget)",
+    )
+    namespace = parser.parse_args()
+
+    run_benchmark(
+        namespace.k,
+        namespace.repeat,
+        [budget or None for budget in namespace.budgets],
+    )
@@ -0,0 +1,87 @@
+import math
+import statistics
+
+# Ranking metrics of the evaluation notebook (`src/notebooks/evaluate.ipynb`), with
+# binary relevance: `ground_truth` are the relevant documents of a query, `predicted`
+# the retrieved ones, best first. Mean values are taken over queries
+
+
+def precision_at_k(ground_truth: list[str], predicted: list[str], k: int) -> float:
+    if k == 0:
+        return 0.0
+    relevant = set(ground_truth)
+    return sum(1 for item in predicted[:k] if item in relevant) / k
+
+
+def recall_at_k(ground_truth: list[str], predicted: list[str], k: int) -> float:
+    if not ground_truth:
+        return 0.0
+    relevant = set(ground_truth)
+    return sum(1 for item in predicted[:k] if item in relevant) / len(ground_truth)
+
+
+def f1_at_k(ground_truth: list[str], predicted: list[str], k: int) -> float:
+    precision = precision_at_k(ground_truth, predicted, k)
+    recall = recall_at_k(ground_truth, predicted, k)
+    if precision + recall == 0:
+        return 0.0
+    return 2 * precision * recall / (precision + recall)
+
+
+def average_precision_at_k(
+    ground_truth: list[str], predicted: list[str], k: int
+) -> float:
+    if not ground_truth or k == 0:
+        return 0.0
+    relevant = set(ground_truth)
+    hits = 0
+    precisions = 0.0
+    for i, item in enumerate(predicted[:k], start=1):
+        if item in relevant:
+            hits += 1
+            precisions += hits / i
+    return precisions / min(len(ground_truth), k)
+
+
+def reciprocal_rank_at_k(ground_truth: list[str], predicted: list[str], k: int) -> float:
+    relevant = set(ground_truth)
+    for i, item in enumerate(predicted[:k], start=1):
+        if item in relevant:
+            return 1 / i
+    return 0.0
+
+
+def dcg_at_k(ground_truth: list[str], predicted: list[str], k: int) -> float:
+    relevant = set(ground_truth)
+    return sum(
+        1 / math.log2(i + 2) for i, item in enumerate(predicted[:k]) if item in relevant
+    )
+
+
+def ndcg_at_k(ground_truth: list[str], predicted: list[str], k: int) -> float:
+    ideal = dcg_at_k(ground_truth, ground_truth, k)
+    if ideal == 0:
+        return 0.0
+    return dcg_at_k(ground_truth, predicted, k) / ideal
+
+
+def ranking_metrics(
+    ground_truths: list[list[str]], predictions: list[list[str]], k_values: list[int]
+) -> dict[str, dict[str, float]]:
+    # Same layout as `data/evaluation/general_metrics.json`: {k: {metric: mean}}
+    def mean(metric, k: int) -> float:
+        return statistics.fmean(
+            metric(ground_truth, predicted, k)
+            for ground_truth, predicted in zip(ground_truths, predictions)
+        )
+
+    return {
+        str(k): {
+            "MAP": mean(average_precision_at_k, k),
+            "MAR": mean(recall_at_k, k),
+            "nDCG": mean(ndcg_at_k, k),
+            "MRR": mean(reciprocal_rank_at_k, k),
+            "F1": mean(f1_at_k, k),
+        }
+        for k in k_values
+    }
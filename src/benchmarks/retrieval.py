@@ -0,0 +1,290 @@
+import argparse
+import datetime
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from src.benchmarks.metrics import ranking_metrics
+from src.pipeline import Indexer, IndexerPipeline
+from src.registry import get_memory_usage
+from src.utils import from_current_file, load_json, save_json
+
+QUERIES_PATH = from_current_file("../data/evaluation/queries.json")
+RESULTS_PATH = from_current_file("../data/evaluation/benchmark.json")
+
+# Figures compared with a previous run: (section, key, higher is better)
+COMPARED = [
+    ("latency_ms", "p50", False),
+    ("latency_ms", "p95", False),
+    ("latency_ms", "p99", False),
+    ("warm_latency_ms", "p50", False),
+    ("memory_mb", "peak", False),
+    ("metrics", "MAP", True),
+    ("metrics", "MRR", True),
+    ("metrics", "nDCG", True),
+]
+
+
+# (name, query, ground truths)
+Query = tuple[str, str, list[str]]
+
+
+def load_queries() -> list[Query]:
+    return [
+        (name, value["query"], value["ground_truths"])
+        for name, value in load_json(QUERIES_PATH).items()
+    ]
+
+
+# Samples the resident set size in the background, to catch the peak of a run
+class MemorySampler:
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> "MemorySampler":
+        self.peak = get_memory_usage()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, get_memory_usage())
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def latency_percentiles(timings: list[float]) -> dict[str, float]:
+    values = np.array(timings) * 1e3
+    return {
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+    }
+
+
+def benchmark_indexer(
+    pipeline: IndexerPipeline,
+    indexer: Indexer,
+    queries: list[Query],
+    k_values: list[int],
+    repeat: int,
+    concurrency: list[int],
+) -> dict:
+    k = max(k_values)
+    texts = [query for _, query, _ in queries]
+
+    def search(text: str) -> list[str]:
+        _, scored_docs = pipeline.index(text, indexer, k=k)
+        return [document for document, _ in scored_docs]
+
+    # The first query loads the indexes the indexer needs
+    memory = get_memory_usage()
+    start = time.perf_counter()
+    search(texts[0])
+    load_time = time.perf_counter() - start
+    load_memory = get_memory_usage() - memory
+
+    with MemorySampler() as sampler:
+        # Cold runs clear the caches first, as a new query would find them. Warm runs
+        # repeat the query right after, hitting memoized spell corrections and query
+        # embeddings (results are never cached)
+        timings, warm_timings, responses = [], [], []
+        for text in texts:
+            for _ in range(repeat):
+                pipeline.clear_caches()
+                start = time.perf_counter()
+                response = search(text)
+                timings.append(time.perf_counter() - start)
+            for _ in range(repeat):
+                start = time.perf_counter()
+                search(text)
+                warm_timings.append(time.perf_counter() - start)
+            responses.append(response)
+
+        # Throughput with `workers` clients sending queries back to back. Every pass
+        # sends each query once, after the caches are cleared
+        qps = {}
+        for workers in concurrency:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                elapsed = 0.0
+                for _ in range(repeat):
+                    pipeline.clear_caches()
+                    start = time.perf_counter()
+                    list(executor.map(search, texts))
+                    elapsed += time.perf_counter() - start
+                qps[str(workers)] = len(texts) * repeat / elapsed
+
+    return {
+        "load_time": load_time,
+        "latency_ms": latency_percentiles(timings),
+        "warm_latency_ms": latency_percentiles(warm_timings),
+        "qps": qps,
+        "memory_mb": {"load": load_memory / 2**20, "peak": sampler.peak / 2**20},
+        "metrics": ranking_metrics(
+            [ground_truths for _, _, ground_truths in queries], responses, k_values
+        ),
+        "responses": {
+            name: response for (name, _, _), response in zip(queries, responses)
+        },
+    }
+
+
+def run_benchmark(
+    indexers: list[Indexer],
+    k_values: list[int],
+    repeat: int,
+    concurrency: list[int],
+    vector_backend: str,
+) -> dict:
+    queries = load_queries()
+    # Results are not cached, every run searches
+    pipeline = IndexerPipeline(vector_backend, cache_size=0)  # type: ignore
+    return {
+        "run": {
+            "commit": git_commit(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "queries": len(queries),
+            "k_values": k_values,
+            "repeat": repeat,
+            "vector_backend": vector_backend,
+        },
+        "indexers": {
+            indexer: benchmark_indexer(
+                pipeline, indexer, queries, k_values, repeat, concurrency
+            )
+            for indexer in indexers
+        },
+    }
+
+
+def print_results(results: dict, previous: dict | None = None, tolerance: float = 0.1):
+    k = str(max(results["run"]["k_values"]))
+    for indexer, result in results["indexers"].items():
+        latency, memory = result["latency_ms"], result["memory_mb"]
+        warm_latency = result["warm_latency_ms"]
+        metrics = result["metrics"][k]
+        print(f"\n{indexer} (loaded in {result['load_time']:.2f}s)")
+        print(
+            f"  latency, ms: p50 {latency['p50']:.2f}, p95 {latency['p95']:.2f}, "
+            f"p99 {latency['p99']:.2f}; warm p50 {warm_latency['p50']:.2f}, "
+            f"p95 {warm_latency['p95']:.2f}"
+        )
+        print(
+            "  QPS: "
+            + ", ".join(
+                f"{qps:.1f} ({workers} clients)" for workers, qps in result["qps"].items()
+            )
+        )
+        print(f"  memory, MB: load {memory['load']:.1f}, peak {memory['peak']:.1f}")
+        print(
+            f"  @{k}: "
+            + ", ".join(f"{name} {value:.3f}" for name, value in metrics.items())
+        )
+
+        previous_result = (previous or {}).get("indexers", {}).get(indexer)
+        if previous_result is None:
+            continue
+        changes = []
+        for section, key, higher_is_better in COMPARED:
+            old, new = previous_result.get(section, {}), result[section]
+            if section == "metrics":
+                old, new = old.get(k, {}), new[k]
+            if key not in old:
+                continue
+            delta = new[key] - old[key]
+            # Timings and memory vary between runs, small changes are noise
+            worse = delta < 0 if higher_is_better else delta > tolerance * abs(old[key])
+            changes.append(f"{key} {delta:+.3f}{' (worse)' if worse else ''}")
+        print(f"  vs {previous['run']['commit']}: " + ", ".join(changes))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark latency, throughput, memory and ranking quality of the "
+        "indexers on the evaluation queries"
+    )
+    parser.add_argument(
+        "-i",
+        "--indexers",
+        nargs="+",
+        default=list(typing.get_args(Indexer)),
+        choices=list(typing.get_args(Indexer)),
+        help="indexers to benchmark (default: all)",
+    )
+    parser.add_argument(
+        "-k",
+        type=int,
+        nargs="+",
+        default=[1, 3, 5, 10],
+        dest="k_values",
+        help="cutoffs of the ranking metrics",
+    )
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="runs of every query")
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+        help="concurrent clients for the QPS measurement",
+    )
+    parser.add_argument("--vector-backend", default="exact", dest="vector_backend")
+    parser.add_argument(
+        "-o", "--output", default=str(RESULTS_PATH), help="results JSON file"
+    )
+    parser.add_argument(
+        "--compare",
+        default=None,
+        help="results JSON of a previous run (default: the output file, if it exists)",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="relative latency or memory increase reported as worse",
+    )
+    namespace = parser.parse_args()
+
+    compare_path = namespace.compare or namespace.output
+    previous = load_json(compare_path) if os.path.exists(compare_path) else None
+
+    results = run_benchmark(
+        namespace.indexers,
+        sorted(namespace.k_values),
+        namespace.repeat,
+        namespace.concurrency,
+        namespace.vector_backend,
+    )
+    print_results(results, previous, namespace.tolerance)
+    save_json(namespace.output, results)
+    print(f"\nSaved to {namespace.output}")
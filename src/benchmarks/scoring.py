@@ -0,0 +1,116 @@
+import argparse
+import math
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from src.inverted_index import InvertedIndex
+from src.utils import from_current_file, load_json, round_float
+
+QUERIES_PATH = from_current_file("../data/evaluation/queries.json")
+
+
+def reference_score(
+    index: InvertedIndex, matching_terms: list[tuple[int, float]], k: int
+) -> list:
+    # TF-IDF scoring as done before the weights were precomputed: idf and tf are
+    # recomputed per query, scores accumulated in a Counter and fully sorted. The
+    # baseline read the same term frequencies from JSON dictionaries, which are no
+    # longer built
+    document_scores = Counter()
+    total_documents = len(index.documents)
+
+    for term_id, distance_coef in matching_terms:
+        start = index.postings_offsets[term_id]
+        end = index.postings_offsets[term_id + 1]
+        doc_ids = index.postings_doc_ids[start:end]
+        idf = math.log(total_documents / (1 + len(doc_ids)))
+        tfs = index.postings_term_freqs[start:end] / index.document_lengths[doc_ids]
+
+        for doc_id, tf in zip(doc_ids.tolist(), tfs.tolist()):
+            document_scores[doc_id] += tf * idf * distance_coef
+
+    # As in the baseline, tied documents keep the order of their first matching term
+    ranked_docs = sorted(document_scores.items(), key=lambda x: -x[1])[:k]
+    return [
+        (index.documents[doc_id], round_float(score, 5)) for doc_id, score in ranked_docs
+    ]
+
+
+def same_up_to_ties(expected: list, actual: list) -> bool:
+    # Same scores at every rank, and the same documents for every score. Documents
+    # tied at the last score may differ, any k of them are a correct top-k
+    if [score for _, score in expected] != [score for _, score in actual]:
+        return False
+    last_score = expected[-1][1] if expected else None
+    return all(
+        {doc for doc, s in expected if s == score}
+        == {doc for doc, s in actual if s == score}
+        for _, score in expected
+        if score != last_score
+    )
+
+
+def measure(func, repeat: int) -> tuple[list, float]:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return result, statistics.median(timings)
+
+
+def run_benchmark(k: int, repeat: int) -> bool:
+    index = InvertedIndex()
+    queries = [v["query"] for v in load_json(QUERIES_PATH).values()]
+
+    all_same, reordered = True, 0
+    totals = Counter()
+    print(
+        f"{'query':<50} {'terms':>6} {'reference, ms':>14} {'vectorized, ms':>15}  same"
+    )
+    for query in queries:
+        matching_terms = index._get_matching_terms(query)
+        expected, reference_time = measure(
+            lambda: reference_score(index, matching_terms, k), repeat
+        )
+        actual, vectorized_time = measure(
+            lambda: index._score(matching_terms, k, "tfidf"), repeat
+        )
+
+        # `InvertedIndex.find` breaks ties by document id instead
+        assert actual == index.find(query, k)
+        same = same_up_to_ties(expected, actual)
+        all_same &= same
+        reordered += same and expected != actual
+        totals.update({"reference": reference_time, "vectorized": vectorized_time})
+        print(
+            f"{query[:50]:<50} {len(matching_terms):>6} {reference_time * 1e3:>14.3f}"
+            f" {vectorized_time * 1e3:>15.3f}"
+            f"  {'NO' if not same else 'ties' if expected != actual else 'yes'}"
+        )
+
+    print(
+        f"\nScoring total: reference {totals['reference'] * 1e3:.2f} ms,"
+        f" vectorized {totals['vectorized'] * 1e3:.2f} ms"
+        f" ({totals['reference'] / max(totals['vectorized'], 1e-9):.1f}x)"
+    )
+    print(f"Same rankings: {all_same} ({reordered} with reordered ties)")
+    return all_same
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare vectorized TF-IDF scoring with the per-query reference"
+    )
+    parser.add_argument("-k", type=int, default=10, help="documents to retrieve")
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=5, help="runs per query (median is kept)"
+    )
+    namespace = parser.parse_args()
+
+    sys.exit(0 if run_benchmark(namespace.k, namespace.repeat) else 1)
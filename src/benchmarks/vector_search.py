@@ -0,0 +1,105 @@
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from src.llm_indexer import LlmTreeIndexer
+from src.utils import from_current_file, load_json
+from src.vector_search import AnnoySearch, BallTreeSearch, ExactSearch, VectorSearch
+
+QUERIES_PATH = from_current_file("../data/evaluation/queries.json")
+
+
+def measure_latency(search: VectorSearch, queries: np.ndarray, k: int, repeat: int):
+    # Median single-query latency, in ms
+    timings = []
+    for _ in range(repeat):
+        for query in queries:
+            start = time.perf_counter()
+            search.query(query[None, :], k)
+            timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1e3
+
+
+def recall_at_k(
+    expected: list[set[int]], search: VectorSearch, queries: np.ndarray, k: int
+):
+    found = search.query(queries, k)
+    return statistics.mean(
+        len(truth & {i for i, _ in result}) / max(len(truth), 1)
+        for truth, result in zip(expected, found)
+    )
+
+
+def run_benchmark(k: int, repeat: int, trees: list[int], search_ks: list[int]):
+    indexer = LlmTreeIndexer(backend="exact")
+    builder = indexer.embedding_builder
+    embeddings = builder.get_embeddings()
+    queries = np.vstack(
+        [builder.embed_query(v["query"]) for v in load_json(QUERIES_PATH).values()]
+    )
+
+    exact = ExactSearch(embeddings)
+    expected = [{i for i, _ in result} for result in exact.query(queries, k)]
+
+    print(f"{len(embeddings)} documents, {len(queries)} queries, k={k}\n")
+    print(f"{'backend':<32} {'setup, ms':>10} {'latency, ms':>12} {'recall@k':>9}")
+
+    def report(name: str, build):
+        start = time.perf_counter()
+        search = build()
+        build_time = (time.perf_counter() - start) * 1e3
+        latency = measure_latency(search, queries, k, repeat)
+        recall = recall_at_k(expected, search, queries, k)
+        print(f"{name:<32} {build_time:>10.1f} {latency:>12.3f} {recall:>9.3f}")
+
+    report("exact", lambda: ExactSearch(embeddings))
+    report("ball_tree", lambda: BallTreeSearch(embeddings))
+    with tempfile.TemporaryDirectory() as directory:
+        for n_trees in trees:
+            for search_k in search_ks:
+                report(
+                    f"annoy (trees={n_trees}, search_k={search_k})",
+                    lambda: AnnoySearch(
+                        embeddings,
+                        os.path.join(directory, f"{n_trees}.ann"),
+                        n_trees=n_trees,
+                        search_k=search_k,
+                    ),
+                )
+
+    start = time.perf_counter()
+    exact.query(queries, k)
+    print(
+        f"\nexact, whole batch in one call: {(time.perf_counter() - start) * 1e3:.3f} ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare recall@k and latency of the LLM indexer vector backends"
+    )
+    parser.add_argument("-k", type=int, default=10, help="documents to retrieve")
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=5, help="runs per query (median is kept)"
+    )
+    parser.add_argument(
+        "--trees", type=int, nargs="+", default=[10, 50, 100], help="Annoy tree counts"
+    )
+    parser.add_argument(
+        "--search-k",
+        type=int,
+        nargs="+",
+        default=[-1, 2000],
+        dest="search_k",
+        help="Annoy search_k values (-1 is n_trees * k)",
+    )
+    namespace = parser.parse_args()
+
+    run_benchmark(namespace.k, namespace.repeat, namespace.trees, namespace.search_k)
@@ -0,0 +1,112 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from src.benchmarks.vector_search import measure_latency, recall_at_k
+from src.utils import from_current_file, load_json
+from src.vector_search import AnnoySearch, ExactSearch
+from src.w2v_indexer import Word2VecIndexer
+
+QUERIES_PATH = from_current_file("../data/evaluation/queries.json")
+
+
+def run_sweep(
+    indexer: Word2VecIndexer,
+    k: int,
+    repeat: int,
+    trees: list[int],
+    jobs: list[int],
+    search_ks: list[int],
+    on_disk: bool,
+):
+    embeddings = np.asarray(indexer.doc_embeddings, dtype=np.float32)
+    queries = [
+        indexer._embed(indexer._tokenize(v["query"]))
+        for v in load_json(QUERIES_PATH).values()
+    ]
+    # Queries without known words are not searched by the indexer either
+    queries = np.vstack([query for query in queries if query.any()])
+
+    exact = ExactSearch(embeddings)
+    expected = [{i for i, _ in result} for result in exact.query(queries, k)]
+
+    print(f"{len(embeddings)} documents, {len(queries)} queries, k={k}\n")
+    print(
+        f"{'trees':>6} {'jobs':>5} {'search_k':>9} {'build, s':>9} {'size, MB':>9} "
+        f"{'latency, ms':>12} {'recall@k':>9}"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for n_trees in trees:
+            for n_jobs in jobs:
+                path = os.path.join(directory, f"{n_trees}_{n_jobs}.ann")
+                start = time.perf_counter()
+                search = AnnoySearch(
+                    embeddings, path, n_trees, n_jobs=n_jobs, on_disk=on_disk
+                )
+                build_time = time.perf_counter() - start
+                size = os.path.getsize(path) / 2**20
+                for search_k in search_ks:
+                    search.search_k = search_k
+                    latency = measure_latency(search, queries, k, repeat)
+                    recall = recall_at_k(expected, search, queries, k)
+                    print(
+                        f"{n_trees:>6} {n_jobs:>5} {search_k:>9} {build_time:>9.2f} "
+                        f"{size:>9.1f} {latency:>12.3f} {recall:>9.3f}"
+                    )
+                search.index.unload()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Sweep Annoy build options of the Word2Vec indexer: build time, "
+        "index size, latency and recall@k against exact cosine search"
+    )
+    parser.add_argument("-k", type=int, default=10, help="documents to retrieve")
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=5, help="runs per query (median is kept)"
+    )
+    parser.add_argument(
+        "--trees",
+        type=int,
+        nargs="+",
+        default=[10, 50, 100, 1000],
+        help="Annoy tree counts",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        nargs="+",
+        default=[1, -1],
+        help="threads building the trees (-1 is all cores)",
+    )
+    parser.add_argument(
+        "--search-k",
+        type=int,
+        nargs="+",
+        default=[-1, 2000],
+        dest="search_k",
+        help="Annoy search_k values (-1 is n_trees * k)",
+    )
+    parser.add_argument(
+        "--on-disk",
+        action="store_true",
+        dest="on_disk",
+        help="build the indexes in their files instead of memory",
+    )
+    namespace = parser.parse_args()
+
+    run_sweep(
+        Word2VecIndexer(),
+        namespace.k,
+        namespace.repeat,
+        namespace.trees,
+        namespace.jobs,
+        namespace.search_k,
+        namespace.on_disk,
+    )
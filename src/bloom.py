@@ -1,9 +1,11 @@
 import os
+from collections import deque
 from pathlib import Path
+from typing import Iterator
 
 import requests
-from pybloom_live import ScalableBloomFilter
 
+from src.timing import TIMER
 from src.utils import from_current_file, remove_path
 
 
@@ -18,6 +20,58 @@ def sanitize_wordlist(words):
     return sorted({w.strip().lower() for w in words if w.strip()})
 
 
+# Aho-Corasick automaton over words: finds every phrase of the list in a single pass
+# over the text, in time linear in its number of words. Transitions are exact word
+# comparisons, so there are no false positives
+class PhraseMatcher:
+    def __init__(self):
+        self._transitions: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        # Lengths (in words) of the phrases that end at each state
+        self._outputs: list[tuple[int, ...]] = [()]
+
+    def __len__(self) -> int:
+        return len(self._transitions)
+
+    def add(self, phrase: list[str]):
+        state = 0
+        for word in phrase:
+            next_state = self._transitions[state].get(word)
+            if next_state is None:
+                next_state = len(self._transitions)
+                self._transitions[state][word] = next_state
+                self._transitions.append({})
+                self._fail.append(0)
+                self._outputs.append(())
+            state = next_state
+        if phrase and len(phrase) not in self._outputs[state]:
+            self._outputs[state] += (len(phrase),)
+
+    def build(self):
+        # Failure links in breadth-first order: the longest proper suffix of a state
+        # that is also a state. Outputs of the suffix are merged in
+        queue = deque(self._transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for word, next_state in self._transitions[state].items():
+                fail = self._fail[state]
+                while fail and word not in self._transitions[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._transitions[fail].get(word, 0)
+                self._outputs[next_state] += self._outputs[self._fail[next_state]]
+                queue.append(next_state)
+
+    def matches(self, words: list[str]) -> Iterator[tuple[int, int]]:
+        # (start, end) of every occurrence, ordered by end
+        state = 0
+        for end, word in enumerate(words, start=1):
+            while state and word not in self._transitions[state]:
+                state = self._fail[state]
+            state = self._transitions[state].get(word, 0)
+            for length in self._outputs[state]:
+                yield (end - length, end)
+
+
 class BloomModerator:
     def __init__(
         self,
@@ -26,11 +80,7 @@ class BloomModerator:
         filename: str = "bad_words.txt",
         phrase_length: int = 5,
     ):
-        self.filter = ScalableBloomFilter(
-            initial_capacity=5000,
-            error_rate=0.001,
-            mode=ScalableBloomFilter.LARGE_SET_GROWTH,
-        )
+        self.matcher = PhraseMatcher()
         self.filename = filename
         self.phrase_length = phrase_length
 
@@ -63,25 +113,29 @@ class BloomModerator:
             f.write("\n".join(sanitize_wordlist(google_en + ldnoobw_en + ldnoobw_rus)))
 
     def _load_words(self):
+        # Phrases longer than `phrase_length` words are not checked
         with open(self._words_path, "r", encoding="utf-8") as f:
             for line in f:
                 line = line.strip().lower()
-                self.filter.add(line)
-                if "_" in line:
-                    self.filter.add(line.replace("_", " "))
+                variants = [line, line.replace("_", " ")] if "_" in line else [line]
+                for phrase in (variant.split() for variant in variants):
+                    if len(phrase) <= self.phrase_length:
+                        self.matcher.add(phrase)
+        self.matcher.build()
 
+    @TIMER.timed("moderation")
     def check_text(self, text: str) -> tuple[str, bool]:
+        # Single bad words come first, then the phrase that starts first (shortest
+        # one on ties)
         words = text.lower().split()
-
-        for word in words:
-            if word in self.filter:
-                return (word, True)
-
-        for i in range(len(words)):
-            for j in range(1, self.phrase_length + 1):
-                if i + j > len(words):
-                    continue
-                phrase = " ".join(words[i : i + j])
-                if phrase in self.filter:
-                    return (phrase, True)
+        first_phrase = None
+        for start, end in self.matcher.matches(words):
+            if end - start == 1:
+                return (words[start], True)
+            if first_phrase is None or (start, end) < first_phrase:
+                first_phrase = (start, end)
+
+        if first_phrase is not None:
+            start, end = first_phrase
+            return (" ".join(words[start:end]), True)
         return ("", False)
@@ -0,0 +1,113 @@
+import hashlib
+import math
+import re
+
+from src.cache import TTLCache
+
+
+def approximate_token_count(text: str) -> int:
+    # Without the tokenizer of the model (API models), ~4 characters per token
+    return math.ceil(len(text) / 4)
+
+
+# Packs retrieved documents into the token budget of a prompt. Documents are taken in
+# the order they were scored: a document that fits is included as is, a longer one is
+# reduced to its header (type, name and module) and its paragraphs most related to the
+# query, in their original order. Packing stops at the first document that does not
+# fit even reduced, so the included documents are always the top ones and their
+# positions match the proposals. Token counts are cached per tokenizer and text
+class ContextBuilder:
+    # Sections smaller than this are not worth including
+    min_section_tokens: int = 16
+
+    def __init__(self, token_budget: int = 3000, cache_size: int = 10000):
+        self.token_budget = token_budget
+        self.token_counts = TTLCache(maxsize=cache_size)
+
+    def build(
+        self,
+        query: str,
+        sources: list[str],
+        tokenizer=None,
+        token_budget: int | None = None,
+    ) -> list[str]:
+        remaining = self.token_budget if token_budget is None else token_budget
+        query_words = set(re.findall(r"\w+", query.lower()))
+
+        context = []
+        for source in sources:
+            tokens = self.count_tokens(source, tokenizer)
+            if tokens > remaining:
+                source = self._reduce(source, query_words, remaining, tokenizer)
+                if source is None:
+                    break
+                tokens = self.count_tokens(source, tokenizer)
+            context.append(source)
+            remaining -= tokens
+            if remaining < self.min_section_tokens:
+                break
+        return context
+
+    def count_tokens(self, text: str, tokenizer=None) -> int:
+        # Keyed on a digest of the text, cached entries do not hold whole documents
+        key = (
+            getattr(tokenizer, "name_or_path", None),
+            hashlib.sha1(text.encode("utf-8")).digest(),
+        )
+        return self.token_counts.get_or_compute(
+            key,
+            lambda: (
+                len(tokenizer.encode(text, add_special_tokens=False))
+                if tokenizer is not None
+                else approximate_token_count(text)
+            ),
+        )
+
+    def _reduce(
+        self, source: str, query_words: set[str], budget: int, tokenizer
+    ) -> str | None:
+        # Same sections as `parse_document_content`: the first two paragraphs are the
+        # element type and "name FROM module", then PARAMETERS, DESCRIPTION and the
+        # rest of the description
+        paragraphs = source.split("\n\n")
+        header = "\n\n".join(paragraphs[:2])
+        remaining = budget - self.count_tokens(header, tokenizer)
+        if remaining < self.min_section_tokens:
+            return None
+
+        # Most query words first, earlier paragraphs on ties
+        ranked = sorted(
+            range(2, len(paragraphs)),
+            key=lambda i: (
+                -len(query_words & set(re.findall(r"\w+", paragraphs[i].lower())))
+            ),
+        )
+        separator = self.count_tokens("\n\n", tokenizer)
+        selected: dict[int, str] = {}
+        for i in ranked:
+            tokens = self.count_tokens(paragraphs[i], tokenizer) + separator
+            if tokens <= remaining:
+                selected[i] = paragraphs[i]
+                remaining -= tokens
+            elif remaining - separator >= self.min_section_tokens:
+                selected[i] = self._truncate(
+                    paragraphs[i], remaining - separator, tokenizer
+                )
+                break
+            else:
+                break
+
+        # Tokens may merge across joined sections: the last one added goes if the
+        # whole text does not fit after all
+        while True:
+            reduced = "\n\n".join([header, *(selected[i] for i in sorted(selected))])
+            if not selected or self.count_tokens(reduced, tokenizer) <= budget:
+                return reduced
+            selected.popitem()
+
+    def _truncate(self, text: str, tokens: int, tokenizer) -> str:
+        if tokenizer is None:
+            return text[: tokens * 4 - 3] + "..."
+        ids = tokenizer.encode(text, add_special_tokens=False)
+        # "..." is a token or two, one more keeps the decoded text within the budget
+        return tokenizer.decode(ids[: max(tokens - 3, 0)]) + "..."
@@ -0,0 +1,116 @@
+import mmap
+import os
+from pathlib import Path
+
+import numpy as np
+
+from src.cache import TTLCache
+from src.manifest import DocumentManifest
+from src.timing import TIMER
+from src.utils import (
+    from_current_file,
+    load_json,
+    parse_document_content,
+    save_array,
+    save_json,
+)
+
+
+# Serves document contents from a single packed file instead of one small file per
+# document. The corpus is packed into `documents.bin` (UTF-8 contents one after the
+# other) with an offset table, the pack is memory-mapped and parsed documents are
+# cached. The pack is rebuilt whenever the corpus manifest reports changes
+class DocumentStore:
+    def __init__(
+        self,
+        store_dir: Path = from_current_file("../data/document_store"),
+        documents_dir: Path = from_current_file(
+            "../data/scrapped/class_data_function__1_1"
+        ),
+        force: bool = False,
+        cache_size: int = 4096,
+    ):
+        self.store_dir = store_dir
+        self.documents_dir = documents_dir
+        self._pack_path = os.path.join(store_dir, "documents.bin")
+        self._offsets_path = os.path.join(store_dir, "offsets.npy")
+        self._names_path = os.path.join(store_dir, "names.json")
+        self.manifest = DocumentManifest(
+            os.path.join(store_dir, "manifest.json"), documents_dir
+        )
+
+        self.names: list[str] = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self._positions: dict[str, int] = {}
+        self._pack: mmap.mmap | bytes = b""
+        self.parsed_documents = TTLCache(maxsize=cache_size)
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        if force or not self._exists() or any(self.manifest.changes()):
+            self.build()
+        self.load()
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._positions
+
+    def _exists(self) -> bool:
+        return (
+            all(
+                os.path.exists(path)
+                for path in (self._pack_path, self._offsets_path, self._names_path)
+            )
+            and self.manifest.exists()
+        )
+
+    def build(self):
+        print("Packing documents...")
+        filenames = sorted(
+            f for f in os.listdir(self.documents_dir) if f.endswith(".txt")
+        )
+        offsets = np.zeros(len(filenames) + 1, dtype=np.int64)
+        # Written aside and renamed, like the offset table
+        temp_path = f"{self._pack_path}.tmp"
+        with open(temp_path, "wb") as pack:
+            for i, filename in enumerate(filenames):
+                with open(os.path.join(self.documents_dir, filename), "rb") as f:
+                    offsets[i + 1] = offsets[i] + pack.write(f.read())
+        os.replace(temp_path, self._pack_path)
+        save_array(self._offsets_path, offsets)
+        save_json(
+            self._names_path, {"names": [f.removesuffix(".txt") for f in filenames]}
+        )
+        self.manifest.commit()
+
+    def load(self):
+        self.names = load_json(self._names_path)["names"]
+        self.offsets = np.load(self._offsets_path)
+        self._positions = {name: i for i, name in enumerate(self.names)}
+        # An empty file cannot be mapped
+        if os.path.getsize(self._pack_path) > 0:
+            with open(self._pack_path, "rb") as f:
+                self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._pack = b""
+        self.parsed_documents.clear()
+
+    def get(self, name: str) -> str:
+        position = self._positions.get(name)
+        if position is None:
+            raise FileNotFoundError(f"Document '{name}' not found")
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return self._pack[start:end].decode("utf-8")
+
+    @TIMER.timed("document_retrieval")
+    def get_many(self, names: list[str]) -> list[str]:
+        return [self.get(name) for name in names]
+
+    def get_parsed(self, name: str) -> dict:
+        # `parse_document_content` fields plus the raw content; shared, do not modify
+        return self.parsed_documents.get_or_compute(name, lambda: self._parse(name))
+
+    def _parse(self, name: str) -> dict:
+        content = self.get(name)
+        return {**parse_document_content(content), "content": content}
@@ -0,0 +1,128 @@
+import contextvars
+import os
+import threading
+import typing
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, NamedTuple
+
+# [(document, score)] of a query, best first
+Ranking = list[tuple[str, float]]
+
+Fusion = typing.Literal["rrf", "blend"]
+
+
+# A retriever taking part in hybrid search. `find_many` returns a ranking per query;
+# `higher_is_better` is False for distances (embedding indexers)
+class Retriever(NamedTuple):
+    name: str
+    find_many: Callable[[list[str], int], list[Ranking]]
+    higher_is_better: bool = True
+    weight: float = 1.0
+
+
+def reciprocal_rank_fusion(
+    rankings: list[Ranking], weights: list[float], k: int = 60
+) -> Ranking:
+    # Only ranks count, so rankings with incomparable scores can be fused as is
+    scores: dict[str, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, (document, _) in enumerate(ranking, start=1):
+            scores[document] = scores.get(document, 0.0) + weight / (k + rank)
+    return sorted(scores.items(), key=lambda x: -x[1])
+
+
+def blend_scores(
+    rankings: list[Ranking], weights: list[float], higher_is_better: list[bool]
+) -> Ranking:
+    # Scores are min-max normalized per ranking (1 is the best document), documents
+    # missing from a ranking get 0 from it
+    scores: dict[str, float] = {}
+    for ranking, weight, higher in zip(rankings, weights, higher_is_better):
+        if not ranking:
+            continue
+        values = [score for _, score in ranking]
+        low, high = min(values), max(values)
+        for document, score in ranking:
+            normalized = 1.0
+            if high > low:
+                normalized = (score - low) / (high - low)
+                if not higher:
+                    normalized = 1 - normalized
+            scores[document] = scores.get(document, 0.0) + weight * normalized
+    return sorted(scores.items(), key=lambda x: -x[1])
+
+
+# Runs several retrievers concurrently (the embedding forward pass and NumPy scoring
+# release the GIL) and fuses their rankings. With a latency budget, retrievers that
+# have not answered once it is spent are left out: the answer is fused from the ones
+# that did (at least one is always waited for), the others finish in the background
+class HybridSearch:
+    def __init__(
+        self,
+        fusion: Fusion = "rrf",
+        latency_budget_ms: float | None = None,
+        depth: int = 50,
+        workers: int | None = None,
+    ):
+        if fusion not in typing.get_args(Fusion):
+            raise RuntimeError(f"Unknown fusion '{fusion}'")
+        self.fusion: Fusion = fusion
+        self.latency_budget_ms = latency_budget_ms
+        self.depth = depth  # documents taken from each retriever
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers or min(32, (os.cpu_count() or 1) + 4),
+            thread_name_prefix="hybrid",
+        )
+
+        self.searches = 0
+        # Retrievers left out because of the latency budget
+        self.skipped: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def find_many(
+        self, retrievers: list[Retriever], queries: list[str], k: int
+    ) -> tuple[list[Ranking], bool]:
+        # Rankings of every query and whether all retrievers answered
+        if not queries:
+            return [], True
+        depth = max(k, self.depth)
+        # Retrievers run in the caller's context, so their stages reach its trace
+        futures = {
+            self._executor.submit(
+                contextvars.copy_context().run, retriever.find_many, queries, depth
+            ): retriever
+            for retriever in retrievers
+        }
+        timeout = (
+            self.latency_budget_ms / 1e3 if self.latency_budget_ms is not None else None
+        )
+        done, pending = wait(futures, timeout=timeout)
+        if not done:
+            done, pending = wait(futures, return_when=FIRST_COMPLETED)
+
+        # Searches that did not start yet are dropped, running ones can not be stopped
+        for future in pending:
+            future.cancel()
+        results = {futures[future]: future.result() for future in done}
+        answered = [retriever for retriever in retrievers if retriever in results]
+        with self._lock:
+            self.searches += 1
+            self.skipped.update(futures[future].name for future in pending)
+
+        fused = [
+            self._fuse([results[retriever][i] for retriever in answered], answered)[:k]
+            for i in range(len(queries))
+        ]
+        return fused, not pending
+
+    def _fuse(self, rankings: list[Ranking], retrievers: list[Retriever]) -> Ranking:
+        weights = [retriever.weight for retriever in retrievers]
+        if self.fusion == "rrf":
+            return reciprocal_rank_fusion(rankings, weights)
+        return blend_scores(
+            rankings, weights, [retriever.higher_is_better for retriever in retrievers]
+        )
+
+    def stats(self) -> dict[str, int | dict[str, int]]:
+        return {"searches": self.searches, "skipped": dict(self.skipped)}
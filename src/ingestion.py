@@ -0,0 +1,160 @@
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, NamedTuple
+
+from nltk.corpus import stopwords
+
+STOP_WORDS = set(stopwords.words("english"))
+
+
+def tokenize(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+def tokenize_ascii(text: str) -> list[str]:
+    # Non-ASCII characters split words
+    return re.findall(r"[a-z0-9_]+", text.lower())
+
+
+def remove_stop_words(words: Iterable[str]) -> list[str]:
+    return [word for word in words if word not in STOP_WORDS]
+
+
+# A corpus document, read and tokenized once for every builder. Builders pick the
+# tokens they index: the inverted and Word2Vec indexes use `words` without stop words,
+# the spell corrector and the LLM embeddings the ASCII-only `ascii_words`
+class Document(NamedTuple):
+    filename: str
+    name: str
+    words: list[str]  # `tokenize`, in order
+    ascii_words: list[str]  # `tokenize_ascii`, in order; `words` for ASCII texts
+
+
+def read_documents(documents_dir: str | Path, filenames: list[str]) -> list[Document]:
+    documents = []
+    for filename in filenames:
+        with open(os.path.join(documents_dir, filename), "r", encoding="utf-8") as f:
+            text = f.read()
+        words = tokenize(text)
+        documents.append(
+            Document(
+                filename,
+                filename.removesuffix(".txt"),
+                words,
+                words if text.isascii() else tokenize_ascii(text),
+            )
+        )
+    return documents
+
+
+def read_corpus(
+    documents_dir: str | Path,
+    filenames: list[str] | None = None,
+    workers: int | None = None,
+    chunk_size: int = 64,
+) -> Iterator[Document]:
+    # Documents in `filenames` order (all corpus files, sorted, by default). Chunks of
+    # `chunk_size` files are read and tokenized in worker processes, at most two chunks
+    # per worker are in flight, so memory stays bounded however large the corpus is
+    if filenames is None:
+        filenames = sorted(f for f in os.listdir(documents_dir) if f.endswith(".txt"))
+    chunks = [filenames[i : i + chunk_size] for i in range(0, len(filenames), chunk_size)]
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+
+    if workers <= 1:
+        for chunk in chunks:
+            yield from read_documents(documents_dir, chunk)
+        return
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(read_documents, documents_dir, chunk))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+# Bounded queue between the corpus reader and one consumer. Once the consumer is done
+# (it did not need the corpus, or failed), documents are no longer queued for it
+class CorpusFeed:
+    def __init__(self, maxsize: int):
+        self.done = False
+        self._queue: queue.Queue[Document | None] = queue.Queue(maxsize=maxsize)
+
+    def put(self, document: Document | None):
+        while not self.done:
+            try:
+                self._queue.put(document, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self) -> Iterator[Document]:
+        while (document := self._queue.get()) is not None:
+            yield document
+
+
+# Reads the corpus once and streams every document to all `consumers`. Each consumer
+# runs in its own thread and gets an iterable of documents; consumers that do not
+# iterate it (e.g. an index that is already built) do not hold the others back, and
+# reading stops early if none of them needs the corpus
+def ingest(
+    documents_dir: str | Path,
+    consumers: list[Callable[[Iterable[Document]], object]],
+    workers: int | None = None,
+    chunk_size: int = 64,
+    max_buffered: int = 1024,
+) -> int:
+    start = time.perf_counter()
+    corpus = read_corpus(documents_dir, workers=workers, chunk_size=chunk_size)
+    # Worker processes are started before the consumer threads
+    first = next(corpus, None)
+
+    feeds = [CorpusFeed(max_buffered) for _ in consumers]
+    errors: list[BaseException] = []
+
+    def consume(consumer: Callable[[Iterable[Document]], object], feed: CorpusFeed):
+        try:
+            consumer(feed)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            feed.done = True
+
+    threads = [
+        threading.Thread(target=consume, args=(consumer, feed), name="ingestion")
+        for consumer, feed in zip(consumers, feeds)
+    ]
+    for thread in threads:
+        thread.start()
+
+    count = 0
+    try:
+        document = first
+        while document is not None and not all(feed.done for feed in feeds):
+            count += 1
+            for feed in feeds:
+                feed.put(document)
+            document = next(corpus, None)
+    finally:
+        corpus.close()
+        for feed in feeds:
+            feed.put(None)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    print(f"Ingested {count} documents in {time.perf_counter() - start:.1f}s")
+    return count
@@ -1,13 +1,24 @@
 import math
 import os
-import re
-import shutil
-from collections import Counter, defaultdict
+import typing
+from collections import Counter
 from pathlib import Path
 
-from nltk.corpus import stopwords
+import numpy as np
 
-from src.utils import from_current_file, load_json, remove_path, round_float, save_json
+from src.ingestion import Document, read_corpus, remove_stop_words, tokenize
+from src.manifest import DocumentManifest
+from src.timing import TIMER
+from src.utils import (
+    from_current_file,
+    load_json,
+    remove_path,
+    round_float,
+    save_array,
+    save_json,
+)
+
+Scoring = typing.Literal["tfidf", "bm25"]
 
 
 def compute_levenshtein_distance(w1: str, w2: str) -> int:
@@ -32,8 +43,69 @@ def compute_levenshtein_distance(w1: str, w2: str) -> int:
     return previous_row[-1]
 
 
+class VocabularyTrie:
+    _word_key = ""  # stored under an empty key so it never collides with a letter
+
+    def __init__(self, words: typing.Iterable[str] = ()):
+        self._root: dict = {}
+        for word in words:
+            self.add(word)
+
+    def add(self, word: str):
+        node = self._root
+        for letter in word:
+            node = node.setdefault(letter, {})
+        node[self._word_key] = word
+
+    def search(self, word: str, max_distance: int) -> list[tuple[str, int]]:
+        # Walks the trie computing one Levenshtein DP row per node, so shared prefixes
+        # are scored once and a whole subtree is skipped as soon as its row minimum
+        # exceeds the distance bound
+        matches: list[tuple[str, int]] = []
+        first_row = list(range(len(word) + 1))
+        if self._word_key in self._root and first_row[-1] <= max_distance:
+            matches.append((self._root[self._word_key], first_row[-1]))
+        for letter, child in self._root.items():
+            if letter != self._word_key:
+                self._search(child, letter, word, first_row, max_distance, matches)
+        return matches
+
+    def _search(
+        self,
+        node: dict,
+        letter: str,
+        word: str,
+        previous_row: list[int],
+        max_distance: int,
+        matches: list[tuple[str, int]],
+    ):
+        current_row = [previous_row[0] + 1]
+        for j, word_letter in enumerate(word):
+            current_row.append(
+                min(
+                    current_row[j] + 1,
+                    previous_row[j + 1] + 1,
+                    previous_row[j] + (word_letter != letter),
+                )
+            )
+
+        if current_row[-1] <= max_distance and self._word_key in node:
+            matches.append((node[self._word_key], current_row[-1]))
+
+        if min(current_row) <= max_distance:
+            for next_letter, child in node.items():
+                if next_letter != self._word_key:
+                    self._search(
+                        child, next_letter, word, current_row, max_distance, matches
+                    )
+
+
 class InvertedIndex:
-    _stop_words = set(stopwords.words("english"))
+    _scorings: list[Scoring] = list(typing.get_args(Scoring))
+    bm25_k1: float = 1.2
+    bm25_b: float = 0.75
+    compaction_ratio: float = 0.2  # share of tombstones that triggers renumbering
+    batch_size: int = 256  # queries scored together by `find_many`
 
     def __init__(
         self,
@@ -43,101 +115,349 @@ class InvertedIndex:
         ),
         max_distance: int = 3,
         force: bool = False,
+        update: bool = False,
+        corpus: typing.Iterable[Document] | None = None,
     ):
         self._index_dir = index_dir
         self._documents_dir = documents_dir
         self.max_distance = max_distance
 
-        self._index_path = os.path.join(self._index_dir, "index.json")
-        self._doc_word_count_path = os.path.join(
-            self._index_dir, "document_word_count.json"
-        )
+        self._manifest_path = os.path.join(self._index_dir, "manifest.json")
+        self._vocabulary_path = os.path.join(self._index_dir, "vocabulary.json")
         self._doc_id_path = os.path.join(self._index_dir, "documents.json")
-        self._doc_len_path = os.path.join(self._index_dir, "document_lengths.json")
+        self._offsets_path = os.path.join(self._index_dir, "postings_offsets.npy")
+        self._doc_ids_path = os.path.join(self._index_dir, "postings_doc_ids.npy")
+        self._term_freqs_path = os.path.join(self._index_dir, "postings_term_freqs.npy")
+        self._doc_len_path = os.path.join(self._index_dir, "document_lengths.npy")
+        self._weights_paths = {
+            scoring: os.path.join(self._index_dir, f"postings_{scoring}.npy")
+            for scoring in self._scorings
+        }
 
-        self.index = defaultdict(set)  # {word : set(document id)}
-        self.document_word_count = defaultdict(Counter)  # {document id -> word -> count}
-        self.documents: dict[str, str] = {}  # {id: document title}
-        self.document_lengths: dict[str, int] = {}  # doc_id -> total words in document
+        self.terms: list[str] = []  # term id -> word, sorted
+        self.term_ids: dict[str, int] = {}  # {word: term id}
+        # document id -> document title, None for tombstoned (removed) documents
+        self.documents: list[str | None] = []
+        # Postings of term `t` are `postings_*[postings_offsets[t]:postings_offsets[t + 1]]`
+        self.postings_offsets = np.zeros(1, dtype=np.int64)
+        self.postings_doc_ids = np.zeros(0, dtype=np.int32)
+        self.postings_term_freqs = np.zeros(0, dtype=np.int32)
+        # {scoring: weight of each posting}
+        self.postings_weights: dict[Scoring, np.ndarray] = {}
+        self.document_lengths = np.zeros(0, dtype=np.int32)  # total words in document
+        self.vocabulary = VocabularyTrie()  # fuzzy lookup over index words
+        self.version = 0  # bumped on every (re)load, so dependent caches can expire
 
-        if force or not os.path.exists(self._index_dir):
+        if force or not os.path.exists(self._weights_paths["bm25"]):
             remove_path(self._index_dir)
             print("Index is not found, creating new...")
-            if force:
-                try:
-                    shutil.rmtree(self._index_dir)
-                except FileNotFoundError:
-                    pass
             os.mkdir(path=self._index_dir)
-            self.build_index()
+            self.build_index(corpus)
             print("Complete!")
 
         self.load_index()
+        if update:
+            self.update_index()
 
     def _tokenize(self, text: str) -> list[str]:
-        return [w for w in re.findall(r"\w+", text.lower()) if w not in self._stop_words]
+        return remove_stop_words(tokenize(text))
 
     def _get_similar_words(self, word: str) -> set[tuple[str, float]]:
-        matches = set()
-        for index_word in self.index:
-            distance = compute_levenshtein_distance(word, index_word)
-            if distance <= self.max_distance:
-                matches.add(
-                    (index_word, 1 / (1 + distance))
-                )  # add inverse distance factor
-        return matches
+        return {
+            (index_word, 1 / (1 + distance))  # add inverse distance factor
+            for index_word, distance in self.vocabulary.search(word, self.max_distance)
+        }
 
-    def build_index(self):
-        for document_id, filename in enumerate(os.listdir(self._documents_dir)):
-            if filename.endswith(".txt"):
-                with open(
-                    os.path.join(self._documents_dir, filename), "r", encoding="utf-8"
-                ) as f:
-                    text = f.read()
-                    self.documents[str(document_id)] = filename[:-4]
-                    words = self._tokenize(text)
-                    self.document_lengths[str(document_id)] = len(words)
-
-                    for word in words:
-                        self.index[word].add(document_id)
-                        self.document_word_count[str(document_id)][word] += 1
-
-        save_json(self._index_path, {k: list(v) for k, v in self.index.items()})
-        save_json(self._doc_word_count_path, self.document_word_count)
-        save_json(self._doc_id_path, self.documents)
-        save_json(self._doc_len_path, self.document_lengths)
+    def _expand_word(self, word: str) -> list[tuple[int, float]]:
+        matching_terms = []
+        for match, distance_coef in self._get_similar_words(word) | {(word, 1)}:
+            term_id = self.term_ids.get(match)
+            if term_id is not None:
+                matching_terms.append((term_id, distance_coef))
+        return matching_terms
 
-    def load_index(self):
-        self.index = {k: set(v) for k, v in load_json(self._index_path).items()}
-        self.document_word_count: dict[str, dict[str, int]] = {
-            k: v for k, v in load_json(self._doc_word_count_path).items()
+    def _get_matching_terms(
+        self, query: str, expansions: dict[str, list[tuple[int, float]]] | None = None
+    ) -> list[tuple[int, float]]:
+        # `expansions` caches fuzzy expansions of words shared by several queries
+        expansions = {} if expansions is None else expansions
+        matching_terms = []
+        for word in self._tokenize(query):
+            if word not in expansions:
+                expansions[word] = self._expand_word(word)
+            matching_terms.extend(expansions[word])
+        return matching_terms
+
+    def _postings_positions(self, term_ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # Positions of the concatenated postings of `term_ids` in the postings arrays
+        starts = self.postings_offsets[term_ids]
+        lengths = self.postings_offsets[term_ids + 1] - starts
+        shifts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return shifts + np.arange(lengths.sum()), lengths
+
+    def _top_k(self, scores: np.ndarray, candidates: np.ndarray, k: int) -> list:
+        if k <= 0:
+            return []
+        candidate_scores = scores[candidates]
+        if len(candidates) > k:
+            # Keep everything tied with the k-th best score, so that ties are always
+            # resolved by document id below
+            kth_score = np.partition(candidate_scores, len(candidates) - k)[-k]
+            is_top = candidate_scores >= kth_score
+            candidates, candidate_scores = candidates[is_top], candidate_scores[is_top]
+        order = np.lexsort((candidates, -candidate_scores))[:k]
+        return [
+            (self.documents[doc_id], round_float(score, 5))
+            for doc_id, score in zip(
+                candidates[order].tolist(), candidate_scores[order].tolist()
+            )
+        ]
+
+    def build_index(self, corpus: typing.Iterable[Document] | None = None):
+        # `corpus` streams the documents when several builders share one corpus pass
+        documents: list[str | None] = []
+        document_word_count: list[Counter] = []
+        for document in (
+            corpus if corpus is not None else read_corpus(self._documents_dir)
+        ):
+            documents.append(document.name)
+            document_word_count.append(self._count_words(document))
+
+        self._save_postings(documents, *self._collect_postings(document_word_count, 0))
+        DocumentManifest(self._manifest_path, self._documents_dir).commit()
+
+    def update_index(self):
+        manifest = DocumentManifest(self._manifest_path, self._documents_dir)
+        if not manifest.exists():
+            print("Index manifest is not found, rebuilding...")
+            self.build_index()
+            self.load_index()
+            return
+
+        added, updated, removed = manifest.changes()
+        if not (added or updated or removed):
+            return
+        print(
+            f"Updating index: {len(added)} added, {len(updated)} updated, "
+            f"{len(removed)} removed"
+        )
+
+        # Changed and removed documents are tombstoned: their postings are dropped,
+        # but their ids stay reserved until the next compaction
+        documents = list(self.documents)
+        document_ids = {title: i for i, title in enumerate(documents) if title}
+        for filename in updated + removed:
+            documents[document_ids[filename[:-4]]] = None
+
+        is_alive = np.array([title is not None for title in documents], dtype=bool)
+        keep = is_alive[self.postings_doc_ids]
+        words = np.repeat(np.array(self.terms), np.diff(self.postings_offsets))[keep]
+        doc_ids = np.asarray(self.postings_doc_ids)[keep]
+        term_freqs = np.asarray(self.postings_term_freqs)[keep]
+
+        new_words, new_doc_ids, new_term_freqs = self._collect_postings(
+            [
+                self._count_words(document)
+                for document in read_corpus(self._documents_dir, added + updated)
+            ],
+            len(documents),
+        )
+        documents.extend(filename[:-4] for filename in added + updated)
+        words = np.concatenate([words, new_words])
+        doc_ids = np.concatenate([doc_ids, new_doc_ids])
+        term_freqs = np.concatenate([term_freqs, new_term_freqs])
+
+        tombstones = documents.count(None)
+        if tombstones > self.compaction_ratio * len(documents):
+            print(f"Compacting {tombstones} tombstoned documents...")
+            is_alive = np.array([title is not None for title in documents], dtype=bool)
+            new_ids = np.cumsum(is_alive) - 1
+            doc_ids = new_ids[doc_ids]
+            documents = [title for title in documents if title is not None]
+
+        self._save_postings(documents, words, doc_ids, term_freqs)
+        manifest.commit()
+        self.load_index()
+
+    def _count_words(self, document: Document) -> Counter:
+        return Counter(remove_stop_words(document.words))
+
+    def _collect_postings(
+        self, document_word_count: list[Counter], first_doc_id: int
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Flat (word, document id, term frequency) of every posting
+        words, doc_ids, term_freqs = [], [], []
+        for document_id, word_count in enumerate(document_word_count, first_doc_id):
+            words.extend(word_count.keys())
+            doc_ids.extend([document_id] * len(word_count))
+            term_freqs.extend(word_count.values())
+        return (
+            np.array(words, dtype=str),
+            np.array(doc_ids, dtype=np.int32),
+            np.array(term_freqs, dtype=np.int32),
+        )
+
+    def _save_postings(
+        self,
+        documents: list[str | None],
+        words: np.ndarray,
+        doc_ids: np.ndarray,
+        term_freqs: np.ndarray,
+    ):
+        vocabulary, term_ids = np.unique(words, return_inverse=True)
+        order = np.lexsort((doc_ids, term_ids))
+        term_ids = term_ids[order]
+        doc_ids = doc_ids[order].astype(np.int32)
+        term_freqs = term_freqs[order].astype(np.int32)
+
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(term_ids, minlength=len(vocabulary)))
+        document_lengths = np.bincount(
+            doc_ids, weights=term_freqs, minlength=len(documents)
+        ).astype(np.int32)
+
+        doc_freqs = np.diff(offsets)
+        postings_lengths = document_lengths[doc_ids]
+        total_documents = len(documents) - documents.count(None)
+
+        # TF-IDF weights are computed exactly as the per-query formula used to, so
+        # rankings stay bit-for-bit identical
+        tfidf_idf = np.array(
+            [math.log(total_documents / (1 + df)) for df in doc_freqs.tolist()]
+        )
+        bm25_idf = np.array(
+            [
+                math.log(1 + (total_documents - df + 0.5) / (df + 0.5))
+                for df in doc_freqs.tolist()
+            ]
+        )
+        average_length = max(document_lengths.sum() / max(total_documents, 1), 1)
+        length_norm = 1 - self.bm25_b + self.bm25_b * postings_lengths / average_length
+        weights: dict[Scoring, np.ndarray] = {
+            "tfidf": (term_freqs / postings_lengths) * np.repeat(tfidf_idf, doc_freqs),
+            "bm25": np.repeat(bm25_idf, doc_freqs)
+            * term_freqs
+            * (self.bm25_k1 + 1)
+            / (term_freqs + self.bm25_k1 * length_norm),
         }
-        self.documents = {k: v for k, v in load_json(self._doc_id_path).items()}
-        self.document_lengths = {k: v for k, v in load_json(self._doc_len_path).items()}
 
-    def find(self, query: str, k: int = 10) -> list:
-        query_words = self._tokenize(query)
-        document_scores = Counter()
-        total_documents = len(self.documents)
+        save_json(self._vocabulary_path, vocabulary.tolist())
+        save_json(self._doc_id_path, dict(enumerate(documents)))
+        save_array(self._offsets_path, offsets)
+        save_array(self._doc_ids_path, doc_ids)
+        save_array(self._term_freqs_path, term_freqs)
+        save_array(self._doc_len_path, document_lengths)
+        # BM25 weights are saved last: their presence marks a complete index
+        for scoring, scoring_weights in weights.items():
+            save_array(self._weights_paths[scoring], scoring_weights)
 
-        for word in query_words:
-            matching_words = self._get_similar_words(word) | {(word, 1)}
+    def load_index(self):
+        self.terms = load_json(self._vocabulary_path)  # type: ignore
+        self.term_ids = {word: term_id for term_id, word in enumerate(self.terms)}
+        documents = load_json(self._doc_id_path)
+        self.documents = [documents[str(i)] for i in range(len(documents))]
+        self.postings_offsets = np.load(self._offsets_path, mmap_mode="r")
+        self.postings_doc_ids = np.load(self._doc_ids_path, mmap_mode="r")
+        self.postings_term_freqs = np.load(self._term_freqs_path, mmap_mode="r")
+        self.document_lengths = np.load(self._doc_len_path, mmap_mode="r")
+        for scoring in self._scorings:
+            self.postings_weights[scoring] = np.load(
+                self._weights_paths[scoring], mmap_mode="r"
+            )
+        self.vocabulary = VocabularyTrie(self.terms)
+        self.version += 1
+
+    def find(
+        self,
+        query: str,
+        k: int = 10,
+        scoring: Scoring = "tfidf",
+    ) -> list:
+        if scoring not in self._scorings:
+            raise RuntimeError(f"Unknown scoring '{scoring}'")
+        with TIMER.span("expansion"):
+            matching_terms = self._get_matching_terms(query)
+        with TIMER.span("scoring"):
+            return self._score(matching_terms, k, scoring)
+
+    def find_many(
+        self,
+        queries: list[str],
+        k: int = 10,
+        scoring: Scoring = "tfidf",
+    ) -> list[list]:
+        if scoring not in self._scorings:
+            raise RuntimeError(f"Unknown scoring '{scoring}'")
+        if k <= 0:
+            return [[] for _ in queries]
+        expansions: dict[str, list[tuple[int, float]]] = {}
+        with TIMER.span("expansion"):
+            batch_terms = [
+                self._get_matching_terms(query, expansions) for query in queries
+            ]
+        with TIMER.span("scoring"):
+            results = []
+            for start in range(0, len(batch_terms), self.batch_size):
+                results.extend(
+                    self._score_many(
+                        batch_terms[start : start + self.batch_size], k, scoring
+                    )
+                )
+            return results
 
-            for match, distance_coef in matching_words:
-                if match in self.index:
-                    doc_freq = len(self.index[match])
-                    idf = math.log(total_documents / (1 + doc_freq))
+    def _score_many(
+        self,
+        batch_terms: list[list[tuple[int, float]]],
+        k: int,
+        scoring: Scoring = "tfidf",
+    ) -> list[list]:
+        # Same as `_score`, but the postings of all queries are gathered and summed
+        # with one `np.bincount` over (query, document) pairs
+        total_documents = len(self.documents)
+        query_terms = [
+            (i, *term) for i, terms in enumerate(batch_terms) for term in terms
+        ]
+        if not query_terms:
+            return [[] for _ in batch_terms]
 
-                    for doc_id_int in self.index[match]:
-                        doc_id = str(doc_id_int)
-                        tf = (
-                            self.document_word_count[doc_id][match]
-                            / self.document_lengths[doc_id]
-                        )
-                        document_scores[doc_id] += tf * idf * distance_coef  # type: ignore
+        query_ids, term_ids, distance_coefs = zip(*query_terms)
+        positions, lengths = self._postings_positions(np.array(term_ids))
+        keys = np.repeat(np.array(query_ids) * total_documents, lengths)
+        keys += self.postings_doc_ids[positions]
+        weights = self.postings_weights[scoring][positions] * np.repeat(
+            distance_coefs, lengths
+        )
+        size = len(batch_terms) * total_documents
+        scores = np.bincount(keys, weights=weights, minlength=size)
+        matched = np.bincount(keys, minlength=size)
 
-        ranked_docs = sorted(document_scores.items(), key=lambda x: -x[1])[:k]
         return [
-            (self.documents[doc_id], round_float(score, 5))
-            for doc_id, score in ranked_docs
+            self._top_k(
+                scores[i * total_documents : (i + 1) * total_documents],
+                np.flatnonzero(matched[i * total_documents : (i + 1) * total_documents]),
+                k,
+            )
+            for i in range(len(batch_terms))
         ]
+
+    def _score(
+        self,
+        matching_terms: list[tuple[int, float]],
+        k: int,
+        scoring: Scoring = "tfidf",
+    ) -> list:
+        if not matching_terms:
+            return []
+
+        # Gather the postings of every expanded term and sum them per document at once
+        term_ids, distance_coefs = zip(*matching_terms)
+        positions, lengths = self._postings_positions(np.array(term_ids))
+        doc_ids = self.postings_doc_ids[positions]
+        weights = self.postings_weights[scoring][positions] * np.repeat(
+            distance_coefs, lengths
+        )
+        total_documents = len(self.documents)
+        scores = np.bincount(doc_ids, weights=weights, minlength=total_documents)
+        matched = np.bincount(doc_ids, minlength=total_documents)
+
+        return self._top_k(scores, np.flatnonzero(matched), k)
@@ -1,18 +1,41 @@
+import functools
 import os
-import re
 from collections import Counter
 from pathlib import Path
-from typing import List
+from typing import Iterable, List, Literal
 
-import joblib
 import numpy as np
-from nltk.corpus import stopwords
 from sentence_transformers import SentenceTransformer
-from sklearn.neighbors import BallTree
 
-from src.utils import from_current_file, load_json, remove_path, save_json
+from src.cache import TTLCache
+from src.ingestion import STOP_WORDS, Document, read_corpus, tokenize_ascii
+from src.manifest import DocumentManifest
+from src.registry import REGISTRY
+from src.timing import TIMER
+from src.utils import (
+    from_current_file,
+    load_json,
+    remove_path,
+    save_array,
+    save_json,
+)
+from src.vector_search import (
+    AnnoySearch,
+    BallTreeSearch,
+    ExactSearch,
+    VectorBackend,
+    VectorSearch,
+)
 
-STOP_WORDS = set(stopwords.words("english"))
+EmbeddingsDtype = Literal["float32", "float16", "int8"]
+
+
+def load_sentence_transformer(model_name: str) -> SentenceTransformer:
+    # Shared by every builder (and pipeline) using the same model
+    return REGISTRY.get(
+        f"sentence_transformer:{model_name}",
+        functools.partial(SentenceTransformer, model_name),
+    )
 
 
 class LlmEmbeddingBuilder:
@@ -25,97 +48,189 @@ class LlmEmbeddingBuilder:
         force: bool = False,
         model_name: str = "all-MiniLM-L6-v2",
         common_word_threshold: float = 0.5,
+        update: bool = False,
+        embeddings_dtype: EmbeddingsDtype = "float32",
+        cache_size: int = 1024,
+        corpus: Iterable[Document] | None = None,
     ):
         self._index_dir = index_dir
         self._documents_dir = documents_dir
 
+        # Memoized query embeddings, keyed by the cleaned query text
+        self.query_embeddings = TTLCache(maxsize=cache_size)
+
         self.model_name = model_name
         self.common_word_threshold = common_word_threshold
-        self.model = SentenceTransformer(self.model_name)
+        self.embeddings_dtype: EmbeddingsDtype = embeddings_dtype
+        self.model = load_sentence_transformer(self.model_name)
+
+        # Stored (possibly quantized) matrix, memory-mapped once loaded
+        self.embeddings: np.ndarray | None = None
+        # Per-row dequantization factors, only for "int8"
+        self.embeddings_scale: np.ndarray | None = None
 
         self.common_words = set()
 
         self._builder_path = os.path.join(self._index_dir, "builder.json")
+        self._embeddings_path = os.path.join(self._index_dir, "embeddings.npy")
+        self._scale_path = os.path.join(self._index_dir, "embeddings_scale.npy")
+        self._manifest_path = os.path.join(self._index_dir, "manifest.json")
 
-        if force or not os.path.exists(self._builder_path):
+        if (
+            force
+            or not os.path.exists(self._builder_path)
+            or not os.path.exists(self._embeddings_path)
+        ):
             remove_path(self._builder_path)
             print("Builder is not found, creating new...")
             os.makedirs(self._index_dir, exist_ok=True)
-            self.build()
+            self.build(corpus)
             print("Complete!")
         else:
             self.load()
+            if update:
+                self.update()
 
-    def build(self):
-        docs = self._load_docs()
-        self._build_embeddings(docs)
+    def build(self, corpus: Iterable[Document] | None = None):
+        # `corpus` streams the documents when several builders share one corpus pass
+        self.documents = []
+        tokenized_docs = []
+        for document in (
+            corpus if corpus is not None else read_corpus(self._documents_dir)
+        ):
+            self.documents.append(document.name)
+            tokenized_docs.append(self._document_tokens(document))
+        self._build_embeddings(tokenized_docs)
         self.save()
+        DocumentManifest(self._manifest_path, self._documents_dir).commit()
+        self.load()
 
-    def _load_docs(self) -> list[str]:
-        sentences = []
-        self.documents = []
-        for _, filename in enumerate(os.listdir(self._documents_dir)):
-            if filename.endswith(".txt"):
-                with open(
-                    os.path.join(self._documents_dir, filename), "r", encoding="utf-8"
-                ) as f:
-                    text = f.read()
-                    self.documents.append(filename[:-4])
-                    sentences.append(f"{filename[:-4]}\n\n{text}")
+    def update(self):
+        manifest = DocumentManifest(self._manifest_path, self._documents_dir)
+        if not manifest.exists():
+            print("Builder manifest is not found, rebuilding...")
+            self.build()
+            return
+
+        added, updated, removed = manifest.changes()
+        if not (added or updated or removed):
+            return
+        print(
+            f"Updating embeddings: {len(added)} added, {len(updated)} updated, "
+            f"{len(removed)} removed"
+        )
 
-        return sentences
+        # Rows of changed documents are dropped rather than tombstoned, since the
+        # tree is rebuilt from the remaining embeddings anyway. Common words stay
+        # fixed until the next full build, so old and new rows are comparable
+        stale = {filename[:-4] for filename in updated + removed}
+        keep = [i for i, title in enumerate(self.documents) if title not in stale]
+        changed = added + updated
+        self.documents = [self.documents[i] for i in keep]
+        embeddings = self.get_embeddings()[keep]
+        if changed:
+            new_embeddings = self.model.encode(
+                [
+                    self._filter_tokens(self._document_tokens(document))
+                    for document in read_corpus(self._documents_dir, changed)
+                ],
+                show_progress_bar=True,
+            )
+            self.documents.extend(filename[:-4] for filename in changed)
+            embeddings = np.concatenate([embeddings, new_embeddings])
+        self._set_embeddings(embeddings)
+        self.save()
+        manifest.commit()
+        self.load()
+
+    def _document_tokens(self, document: Document) -> List[str]:
+        # Documents are embedded with their name in front
+        return tokenize_ascii(document.name) + document.ascii_words
 
     def _tokenize(self, text: str) -> List[str]:
-        text = text.lower()
-        text = re.sub(r"[^a-z0-9_]+", " ", text)
-        return text.split()
+        return tokenize_ascii(text)
 
-    def _preprocess(self, docs: List[str]) -> List[str]:
-        tokenized_docs = []
+    def _preprocess(self, tokenized_docs: List[List[str]]) -> List[str]:
         word_counts = Counter()
-
-        for doc in docs:
-            tokens = self._tokenize(doc)
-            tokenized_docs.append(tokens)
+        for tokens in tokenized_docs:
             word_counts.update(set(tokens))
 
-        doc_count = len(docs)
+        doc_count = len(tokenized_docs)
         self.common_words = {
             word
             for word, freq in word_counts.items()
             if freq / doc_count > self.common_word_threshold
         }
 
-        cleaned_docs = []
-        for tokens in tokenized_docs:
-            filtered = [
-                t for t in tokens if t not in STOP_WORDS and t not in self.common_words
-            ]
-            cleaned_docs.append(" ".join(filtered))
+        return [self._filter_tokens(tokens) for tokens in tokenized_docs]
 
-        return cleaned_docs
+    def _filter_tokens(self, tokens: List[str]) -> str:
+        filtered = [
+            t for t in tokens if t not in STOP_WORDS and t not in self.common_words
+        ]
+        return " ".join(filtered)
 
-    def _build_embeddings(self, docs: List[str]):
-        self.cleaned_documents = self._preprocess(docs)
-        self.embeddings = self.model.encode(
-            self.cleaned_documents, show_progress_bar=True
+    def _clean(self, text: str) -> str:
+        return self._filter_tokens(self._tokenize(text))
+
+    def _build_embeddings(self, tokenized_docs: List[List[str]]):
+        self.cleaned_documents = self._preprocess(tokenized_docs)
+        self._set_embeddings(
+            self.model.encode(self.cleaned_documents, show_progress_bar=True)
         )
 
+    def _set_embeddings(self, embeddings: np.ndarray):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.embeddings_scale = None
+        if self.embeddings_dtype == "int8":
+            # Symmetric per-row quantization: each row is scaled so that its largest
+            # absolute component maps to 127
+            scale = np.abs(embeddings).max(axis=1) / 127
+            scale[scale == 0] = 1
+            self.embeddings = np.round(embeddings / scale[:, None]).astype(np.int8)
+            self.embeddings_scale = scale.astype(np.float32)
+        else:
+            self.embeddings = embeddings.astype(self.embeddings_dtype)
+
+    def get_embeddings(self) -> np.ndarray:
+        # Document embeddings as float32, dequantized if needed
+        if self.embeddings is None:
+            raise ValueError("Embeddings not built or loaded.")
+        if self.embeddings_scale is not None:
+            return self.embeddings * self.embeddings_scale[:, None]
+        return np.asarray(self.embeddings, dtype=np.float32)
+
     def embed_query(self, query: str) -> np.ndarray:
-        tokens = self._tokenize(query)
-        filtered = [
-            t for t in tokens if t not in STOP_WORDS and t not in self.common_words
-        ]
-        cleaned = " ".join(filtered)
-        return self.model.encode([cleaned])
+        return self.embed_queries([query])
+
+    @TIMER.timed("embedding")
+    def embed_queries(self, queries: list[str]) -> np.ndarray:
+        cleaned_queries = [self._clean(query) for query in queries]
+        embeddings = {
+            query: self.query_embeddings.get(query) for query in cleaned_queries
+        }
+        missing = [query for query, embedding in embeddings.items() if embedding is None]
+        if missing:
+            for query, embedding in zip(missing, self.model.encode(missing)):
+                self.query_embeddings.set(query, embedding)
+                embeddings[query] = embedding
+        return np.vstack([embeddings[query] for query in cleaned_queries])
 
     def save(self):
         metadata = {
             "common_words": list(self.common_words),
             "common_word_threshold": self.common_word_threshold,
             "model_name": self.model_name,
+            "embeddings_dtype": self.embeddings_dtype,
             "documents": self.documents,
         }
+        if self.embeddings is None:
+            raise ValueError("Embeddings not built.")
+        if self.embeddings_scale is not None:
+            save_array(self._scale_path, self.embeddings_scale)
+        else:
+            remove_path(self._scale_path)
+        save_array(self._embeddings_path, self.embeddings)
         save_json(self._builder_path, metadata)
 
     def load(self):
@@ -123,9 +238,23 @@ class LlmEmbeddingBuilder:
 
         self.common_words = set(metadata["common_words"])
         self.common_word_threshold = metadata["common_word_threshold"]
-        self.model_name = metadata["model_name"]
         self.documents = metadata["documents"]
-        self.model = SentenceTransformer(self.model_name)
+        self.query_embeddings.clear()
+        if metadata["model_name"] != self.model_name:
+            self.model_name = metadata["model_name"]
+            self.model = load_sentence_transformer(self.model_name)
+
+        # Memory-mapped, so startup does not read (or re-encode) the whole matrix
+        stored_dtype = metadata.get("embeddings_dtype", "float32")
+        self.embeddings = np.load(self._embeddings_path, mmap_mode="r")
+        self.embeddings_scale = (
+            np.load(self._scale_path) if stored_dtype == "int8" else None
+        )
+        if stored_dtype != self.embeddings_dtype:
+            # Converted from the stored vectors, no re-encoding needed
+            self._set_embeddings(self.get_embeddings())
+            self.save()
+            self.load()
 
 
 class LlmTreeIndexer:
@@ -136,44 +265,68 @@ class LlmTreeIndexer:
             "../data/scrapped/class_data_function__1_1"
         ),
         force: bool = False,
+        update: bool = False,
+        embeddings_dtype: EmbeddingsDtype = "float32",
+        backend: VectorBackend = "exact",
+        annoy_trees: int = 50,
+        annoy_search_k: int = -1,
+        corpus: Iterable[Document] | None = None,
     ):
         self._index_dir = index_dir
         self._documents_dir = documents_dir
+        self.backend: VectorBackend = backend
         self.embedding_builder = LlmEmbeddingBuilder(
-            self._index_dir, self._documents_dir, force=force
+            self._index_dir,
+            self._documents_dir,
+            force=force,
+            update=update,
+            embeddings_dtype=embeddings_dtype,
+            corpus=corpus,
         )
 
-        self._tree_path = os.path.join(self._index_dir, "tree.pkl")
+        self._annoy_path = os.path.join(self._index_dir, f"embeddings_{annoy_trees}.ann")
+        self.annoy_trees = annoy_trees
+        self.annoy_search_k = annoy_search_k
+        self.version = 0  # bumped on every (re)build, so dependent caches can expire
 
-        if force or not os.path.exists(self._tree_path):
-            remove_path(self._tree_path)
-            print("Tree is not found, creating new...")
-            os.makedirs(self._index_dir, exist_ok=True)
-            self.build_tree()
-            print("Complete!")
-        else:
-            self.load()
+        self.build_search(force)
 
-    def build_tree(self):
-        if self.embedding_builder.embeddings is None:
-            raise ValueError("Embeddings not built or loaded.")
-        self.tree = BallTree(self.embedding_builder.embeddings, metric="euclidean")
-        self.save()
-
-    def save(self):
-        if self.tree is None:
-            raise ValueError("BallTree not built.")
-        joblib.dump(self.tree, self._tree_path)
+    def build_search(self, force: bool = False):
+        # Search structures are not pickled: they are built from (or, for Annoy,
+        # next to) the memory-mapped embeddings, which is cheaper than unpickling
+        embeddings = self.embedding_builder.get_embeddings()
+        if self.backend == "ball_tree":
+            self.search: VectorSearch = BallTreeSearch(embeddings)
+        elif self.backend == "exact":
+            self.search = ExactSearch(embeddings)
+        elif self.backend == "annoy":
+            rebuild = force or (
+                os.path.exists(self._annoy_path)
+                and os.path.getmtime(self._annoy_path)
+                < os.path.getmtime(self.embedding_builder._embeddings_path)
+            )
+            self.search = AnnoySearch(
+                embeddings,
+                self._annoy_path,
+                n_trees=self.annoy_trees,
+                search_k=self.annoy_search_k,
+                rebuild=rebuild,
+            )
+        else:
+            raise RuntimeError(f"Unknown vector backend '{self.backend}'")
+        self.version += 1
 
-    def load(self):
-        self.tree = joblib.load(self._tree_path)
+    def find(self, query: str, k: int = 5) -> list[tuple[str, float]]:
+        return self.find_many([query], k)[0]
 
-    def find(self, query: str, k: int = 5):
-        if self.tree is None:
-            raise ValueError("BallTree not built or loaded.")
-        query_embedding = self.embedding_builder.embed_query(query)
-        dist, ind = self.tree.query(query_embedding, k=k)
+    def find_many(self, queries: list[str], k: int = 5) -> list[list[tuple[str, float]]]:
+        if not queries:
+            return []
+        # One encode call and one search call for the whole batch
+        query_embeddings = self.embedding_builder.embed_queries(queries)
+        with TIMER.span("vector_search"):
+            results = self.search.query(query_embeddings, k)
         return [
-            (self.embedding_builder.documents[i], dist[0][j])
-            for j, i in enumerate(ind[0])
+            [(self.embedding_builder.documents[i], distance) for i, distance in result]
+            for result in results
         ]
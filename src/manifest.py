@@ -0,0 +1,61 @@
+import hashlib
+import os
+from pathlib import Path
+
+from src.utils import load_json, save_json
+
+
+def hash_file(path: str | Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+# Tracks content hashes of corpus files, so builders can find what changed since
+# their last run instead of reprocessing the whole corpus
+class DocumentManifest:
+    def __init__(self, path: str | Path, documents_dir: str | Path):
+        self._path = path
+        self._documents_dir = documents_dir
+        # {filename: {"mtime": float, "size": int, "hash": str}}
+        self.entries: dict[str, dict] = load_json(self._path, allow_empty=True)
+        self._pending: dict[str, dict] = {}
+
+    def exists(self) -> bool:
+        return os.path.exists(self._path)
+
+    def _scan(self) -> dict[str, dict]:
+        entries = {}
+        for filename in sorted(os.listdir(self._documents_dir)):
+            if not filename.endswith(".txt"):
+                continue
+            path = os.path.join(self._documents_dir, filename)
+            stat = os.stat(path)
+            entry = {"mtime": stat.st_mtime, "size": stat.st_size}
+            previous = self.entries.get(filename)
+            if (
+                previous is not None
+                and previous["mtime"] == entry["mtime"]
+                and previous["size"] == entry["size"]
+            ):
+                entry["hash"] = previous["hash"]  # untouched file, skip hashing
+            else:
+                entry["hash"] = hash_file(path)
+            entries[filename] = entry
+        return entries
+
+    def changes(self) -> tuple[list[str], list[str], list[str]]:
+        # (added, updated, removed) filenames; call `commit` once they are applied
+        self._pending = self._scan()
+        added = [f for f in self._pending if f not in self.entries]
+        updated = [
+            f
+            for f, entry in self._pending.items()
+            if f in self.entries and self.entries[f]["hash"] != entry["hash"]
+        ]
+        removed = [f for f in self.entries if f not in self._pending]
+        return added, updated, removed
+
+    def commit(self):
+        self.entries = self._pending or self._scan()
+        self._pending = {}
+        save_json(self._path, self.entries)
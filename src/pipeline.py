@@ -1,11 +1,18 @@
+import functools
 import typing
 
 from src.bloom import BloomModerator
+from src.cache import TTLCache
+from src.document_store import DocumentStore
+from src.hybrid import Fusion, HybridSearch, Retriever
 from src.inverted_index import InvertedIndex
 from src.llm_indexer import LlmTreeIndexer
 from src.rag import RetrievalAugmentedGeneration
 from src.rag_local import RetrievalAugmentedGenerationLocal
+from src.registry import REGISTRY
 from src.spellcheck import NorvigSpellCorrector
+from src.vector_search import VectorBackend
+from src.w2v_indexer import Word2VecIndexer
 
 PipelineOutput = tuple[
     str, list[tuple[str, float]]
@@ -27,27 +34,202 @@ ApiModel = typing.Literal[
 
 LocalModel = typing.Literal["arnir0/Tiny-LLM", "sshleifer/tiny-gpt2"]
 
-Indexer = typing.Literal["llm_tree_idx", "inverted_idx"]
+Indexer = typing.Literal[
+    "llm_tree_idx", "inverted_idx", "bm25_idx", "w2v_idx", "hybrid_idx"
+]
 
 
 class IndexerPipeline:
     _available_indexers: list[Indexer] = list(typing.get_args(Indexer))
 
-    def __init__(self) -> None:
-        self.indexer = InvertedIndex()
-        self.llm_indexer = LlmTreeIndexer()
-        self.corrector = NorvigSpellCorrector()
+    def __init__(
+        self,
+        vector_backend: VectorBackend = "exact",
+        cache_size: int = 1024,
+        cache_ttl: float | None = 600,
+        w2v_search_k: int = -1,
+        w2v_prefault: bool = False,
+        hybrid_fusion: Fusion = "rrf",
+        hybrid_budget_ms: float | None = None,
+    ) -> None:
+        # Components are owned by the registry and loaded on first use
+        self._llm_indexer_name = f"llm_indexer:{vector_backend}"
+        REGISTRY.register("inverted_index", InvertedIndex)
+        REGISTRY.register(
+            self._llm_indexer_name,
+            functools.partial(LlmTreeIndexer, backend=vector_backend),
+        )
+        REGISTRY.register(
+            "w2v_indexer",
+            functools.partial(
+                Word2VecIndexer, search_k=w2v_search_k, prefault=w2v_prefault
+            ),
+        )
+        REGISTRY.register("spell_corrector", NorvigSpellCorrector)
+        REGISTRY.register("documents", DocumentStore)
+
+        # BM25 and LLM embeddings searched concurrently, for "hybrid_idx"
+        self.hybrid = HybridSearch(hybrid_fusion, latency_budget_ms=hybrid_budget_ms)
+
+        # Results of recent queries; dropped whenever any index is reloaded
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._cache_version = self._indexes_version()
+
+    @property
+    def indexer(self) -> InvertedIndex:
+        return REGISTRY.get("inverted_index")
+
+    @property
+    def llm_indexer(self) -> LlmTreeIndexer:
+        return REGISTRY.get(self._llm_indexer_name)
+
+    @property
+    def w2v_indexer(self) -> Word2VecIndexer:
+        return REGISTRY.get("w2v_indexer")
+
+    @property
+    def corrector(self) -> NorvigSpellCorrector:
+        return REGISTRY.get("spell_corrector")
+
+    @property
+    def documents(self) -> DocumentStore:
+        return REGISTRY.get("documents")
+
+    def _indexes_version(self) -> tuple[int, ...]:
+        # Components that are not loaded yet can not have produced cached results
+        return tuple(
+            getattr(REGISTRY.peek(name), "version", 0)
+            for name in (
+                "inverted_index",
+                self._llm_indexer_name,
+                "w2v_indexer",
+                "spell_corrector",
+            )
+        )
+
+    def _cache_key(
+        self, query: str, indexer: Indexer, k: int
+    ) -> tuple[str, Indexer, int]:
+        # Every component lowercases and tokenizes the query, so queries that differ
+        # only in case and spacing share an entry
+        return (" ".join(query.lower().split()), indexer, k)
+
+    def _validate_cache(self):
+        version = self._indexes_version()
+        if version != self._cache_version:
+            self.cache.clear()
+            self._cache_version = version
+
+    def index(
+        self,
+        query: str,
+        indexer: Indexer,
+        k: int = 10,
+    ) -> PipelineOutput:
+        self._validate_cache()
+        key = self._cache_key(query, indexer, k)
+        output = self.cache.get(key)
+        if output is None:
+            output, complete = self._index(query, indexer, k)
+            # Hybrid results missing a retriever that was over the latency budget
+            # are not kept
+            if complete:
+                self.cache.set(key, output)
+        return output
+
+    def _index(self, query: str, indexer: Indexer, k: int) -> tuple[PipelineOutput, bool]:
+        if indexer == "hybrid_idx":
+            outputs, complete = self._index_many([query], indexer, k)
+            return outputs[0], complete
 
-    def index(self, query: str, indexer: Indexer, k: int = 10) -> PipelineOutput:
         corrected_query = self.corrector.spell_correction(query)
         if indexer == "llm_tree_idx":
             scored_docs = self.llm_indexer.find(corrected_query, k=k)
         elif indexer == "inverted_idx":
             scored_docs = self.indexer.find(corrected_query, k=k)
+        elif indexer == "bm25_idx":
+            scored_docs = self.indexer.find(corrected_query, k=k, scoring="bm25")
+        elif indexer == "w2v_idx":
+            scored_docs = self.w2v_indexer.find(corrected_query, k=k)
+        else:
+            raise RuntimeError(f"Unknown indexer '{indexer}'")
+
+        return (corrected_query, scored_docs), True
+
+    def index_many(
+        self,
+        queries: list[str],
+        indexer: Indexer,
+        k: int = 10,
+    ) -> list[PipelineOutput]:
+        self._validate_cache()
+        keys = [self._cache_key(query, indexer, k) for query in queries]
+        results = {key: self.cache.get(key) for key in keys}
+
+        # Only cache misses are searched, still as a single batch
+        missing = {
+            key: query for key, query in zip(keys, queries) if results[key] is None
+        }
+        if missing:
+            outputs, complete = self._index_many(list(missing.values()), indexer, k)
+            for key, output in zip(missing, outputs):
+                if complete:
+                    self.cache.set(key, output)
+                results[key] = output
+        return [results[key] for key in keys]  # type: ignore
+
+    def _index_many(
+        self, queries: list[str], indexer: Indexer, k: int
+    ) -> tuple[list[PipelineOutput], bool]:
+        corrected_queries = [self.corrector.spell_correction(query) for query in queries]
+        complete = True
+        if indexer == "hybrid_idx":
+            batch_docs, complete = self.hybrid.find_many(
+                self._hybrid_retrievers(), corrected_queries, k
+            )
+        elif indexer == "llm_tree_idx":
+            batch_docs = self.llm_indexer.find_many(corrected_queries, k=k)
+        elif indexer == "inverted_idx":
+            batch_docs = self.indexer.find_many(corrected_queries, k=k)
+        elif indexer == "bm25_idx":
+            batch_docs = self.indexer.find_many(corrected_queries, k=k, scoring="bm25")
+        elif indexer == "w2v_idx":
+            batch_docs = self.w2v_indexer.find_many(corrected_queries, k=k)
         else:
             raise RuntimeError(f"Unknown indexer '{indexer}'")
 
-        return (corrected_query, scored_docs)
+        return list(zip(corrected_queries, batch_docs)), complete
+
+    def _hybrid_retrievers(self) -> list[Retriever]:
+        # Indexes are loaded here, so loading does not count towards the budget
+        indexer, llm_indexer = self.indexer, self.llm_indexer
+        return [
+            Retriever(
+                "bm25_idx",
+                lambda queries, k: indexer.find_many(queries, k=k, scoring="bm25"),
+            ),
+            Retriever("llm_tree_idx", llm_indexer.find_many, higher_is_better=False),
+        ]
+
+    def cache_stats(self) -> dict[str, dict]:
+        stats = {"results": self.cache.stats()}
+        if (corrector := REGISTRY.peek("spell_corrector")) is not None:
+            stats["spell_corrections"] = corrector.corrections.stats()
+        if (llm_indexer := REGISTRY.peek(self._llm_indexer_name)) is not None:
+            stats["query_embeddings"] = (
+                llm_indexer.embedding_builder.query_embeddings.stats()
+            )
+        return stats
+
+    def clear_caches(self):
+        # Cached results and memoized work of the loaded components (spell
+        # corrections, query embeddings); the indexes stay loaded
+        self.cache.clear()
+        if (corrector := REGISTRY.peek("spell_corrector")) is not None:
+            corrector.corrections.clear()
+            corrector.candidates.clear()
+        if (llm_indexer := REGISTRY.peek(self._llm_indexer_name)) is not None:
+            llm_indexer.embedding_builder.query_embeddings.clear()
 
     @property
     def available_indexers(self) -> list[Indexer]:
@@ -59,11 +241,57 @@ class RAGPipeline:
     _available_local_models: list[LocalModel] = list(typing.get_args(LocalModel))
     _max_local_k: int = 8
 
-    def __init__(self) -> None:
-        self.rag = RetrievalAugmentedGeneration()
-        self.rag_local = RetrievalAugmentedGenerationLocal()
-        self.indexer = IndexerPipeline()
-        self.moderator = BloomModerator()
+    def __init__(
+        self,
+        indexer: IndexerPipeline | None = None,
+        vector_backend: VectorBackend = "exact",
+        local_preload: list[LocalModel] | None = None,
+        local_memory_budget_mb: float | None = None,
+        local_quantize: bool = False,
+        local_max_batch_size: int = 8,
+        local_batch_wait_ms: float = 10,
+        context_tokens: int = 3000,
+    ) -> None:
+        # Reuses the search pipeline (and its result cache) when one is given
+        self.indexer = indexer if indexer is not None else IndexerPipeline(vector_backend)
+        REGISTRY.register(
+            "rag",
+            functools.partial(
+                RetrievalAugmentedGeneration, context_tokens=context_tokens
+            ),
+        )
+        REGISTRY.register(
+            "rag_local",
+            functools.partial(
+                RetrievalAugmentedGenerationLocal,
+                preload=local_preload,
+                memory_budget_mb=local_memory_budget_mb,
+                quantize=local_quantize,
+                max_batch_size=local_max_batch_size,
+                batch_wait_ms=local_batch_wait_ms,
+                context_tokens=context_tokens,
+            ),
+        )
+        REGISTRY.register("moderator", BloomModerator)
+        if local_preload:
+            REGISTRY.get("rag_local")
+
+    @property
+    def rag(self) -> RetrievalAugmentedGeneration:
+        return REGISTRY.get("rag")
+
+    @property
+    def rag_local(self) -> RetrievalAugmentedGenerationLocal:
+        return REGISTRY.get("rag_local")
+
+    @property
+    def moderator(self) -> BloomModerator:
+        return REGISTRY.get("moderator")
+
+    def local_stats(self) -> dict[str, dict]:
+        # Loaded local models with their generation queue and batching figures
+        rag_local = REGISTRY.peek("rag_local")
+        return rag_local.pool.stats() if rag_local is not None else {}
 
     def request(
         self,
@@ -72,17 +300,40 @@ class RAGPipeline:
         k: int,
         indexer: Indexer,
     ):
+        return self.generate(query, model, self.retrieve(query, model, k, indexer))
+
+    def retrieve(
+        self,
+        query: str,
+        model: ApiModel | LocalModel,
+        k: int,
+        indexer: Indexer,
+    ) -> list[tuple[str, float]]:
+        # CPU-bound part of a request: validation, moderation and search
         bad_phrase, is_bad = self.moderator.check_text(query)
         if is_bad:
             raise RuntimeError(f"Bad phrase '{bad_phrase}'")
-        _, scored_docs = self.indexer.index(query, indexer, k=k)
-        if model in self._available_api_models:
-            return self.rag.generate_stream(query, model, scored_docs)
-        elif model in self._available_local_models:
+        if model in self._available_local_models:
             if k > self._max_local_k:
                 raise RuntimeError(
                     f"Local models only support k <= {self._max_local_k}, but got {k}."
                 )
+        elif model not in self._available_api_models:
+            raise RuntimeError(f"Unknown model '{model}'")
+        _, scored_docs = self.indexer.index(query, indexer, k=k)
+        return scored_docs
+
+    def generate(
+        self,
+        query: str,
+        model: ApiModel | LocalModel,
+        scored_docs: list[tuple[str, float]],
+    ):
+        # Async generator for API models, sync generator (iterated in a thread by
+        # the server) for local ones
+        if model in self._available_api_models:
+            return self.rag.generate_stream(query, model, scored_docs)
+        elif model in self._available_local_models:
             return self.rag_local.generate_stream(query, model, scored_docs)
         else:
             raise RuntimeError(f"Unknown model '{model}'")
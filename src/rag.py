@@ -1,11 +1,13 @@
 import asyncio
 import json
-import os
 import time
 
 from g4f.client import AsyncClient, Client
 
-from src.utils import from_current_file, load
+from src.context import ContextBuilder
+from src.document_store import DocumentStore
+from src.registry import REGISTRY
+from src.timing import TIMER
 
 
 def get_prompt(query: str, sources: list[str]) -> str:
@@ -38,19 +40,21 @@ def get_prompt(query: str, sources: list[str]) -> str:
 
 
 class RetrievalAugmentedGeneration:
-    folder_path = from_current_file("../data/scrapped/class_data_function__1_1")
     response_timeout_seconds: float = 30.0
 
-    def __init__(self):
+    def __init__(self, context_tokens: int = 3000):
         self.client = AsyncClient()
         self.sync_client = Client()
+        # Remote models do not expose their tokenizer, tokens are estimated
+        self.context = ContextBuilder(context_tokens)
 
-    def generate_stream(
+    async def generate_stream(
         self, query: str, model: str, scored_docs: list[tuple[str, float]]
     ):
         start = time.time()
-        source_names = [x for x, _ in scored_docs]
-        sources = self._retrieve_docs(source_names)
+        time_to_first_token = None
+        # Document reads and token counting are blocking, they run in a thread
+        sources = await asyncio.to_thread(self._build_sources, query, scored_docs)
 
         prompt = get_prompt(query, sources)
         messages = [{"role": "user", "content": prompt, "additional_data": []}]
@@ -66,9 +70,6 @@ class RetrievalAugmentedGeneration:
         )
 
         try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-
             response = self.client.chat.completions.create(
                 model=model,
                 messages=messages,
@@ -78,44 +79,53 @@ class RetrievalAugmentedGeneration:
                 max_tokens=500,
             )
 
-            delay = 0.05
-            max_iters = int(self.response_timeout_seconds // delay)
+            # Chunks are forwarded as soon as they arrive, on the server event loop
             try:
-                for _ in range(max_iters):
-                    chunk = loop.run_until_complete(
-                        asyncio.wait_for(
-                            response.__anext__(),  # type: ignore
-                            timeout=self.response_timeout_seconds,
-                        )
+                while True:
+                    chunk = await asyncio.wait_for(
+                        anext(response),  # type: ignore
+                        timeout=self.response_timeout_seconds,
                     )
 
                     if chunk.choices[0].delta.content:
+                        if time_to_first_token is None:
+                            time_to_first_token = time.time() - start
+                            TIMER.observe("llm_time_to_first_token", time_to_first_token)
                         yield (
                             json.dumps(
                                 {"type": "chunk", "data": chunk.choices[0].delta.content}
                             )
                             + "\n\n"
                         )
-                    time.sleep(delay)
             except asyncio.TimeoutError as e:
                 raise TimeoutError("Timed out waiting for the model response") from e
             except StopAsyncIteration:
                 # Generator finished
                 pass
             finally:
-                loop.run_until_complete(response.aclose())  # type: ignore
-                loop.close()
+                await response.aclose()  # type: ignore
 
-        except BaseException as e:
+        except Exception as e:
             yield json.dumps({"type": "error", "data": str(e)}) + "\n\n"
 
-        yield (json.dumps({"type": "complete", "data": time.time() - start}) + "\n\n")
+        total = time.time() - start
+        TIMER.observe("llm_generation", total)
+        yield (
+            json.dumps(
+                {
+                    "type": "complete",
+                    "data": total,
+                    "time_to_first_token": time_to_first_token,
+                }
+            )
+            + "\n\n"
+        )
 
     async def get_answer_async(
         self, query: str, model: str, scored_docs: list[tuple[str, float]]
     ) -> tuple[str, list[str]]:
         source_names = [x for x, _ in scored_docs]
-        sources = self._retrieve_docs(source_names)
+        sources = await asyncio.to_thread(self._build_sources, query, scored_docs)
         prompt = get_prompt(query, sources)
         messages = [{"role": "user", "content": prompt}]
 
@@ -124,12 +134,18 @@ class RetrievalAugmentedGeneration:
         )
         return response.choices[0].message.content, source_names
 
-    def _retrieve_docs(self, source_names: list[str]) -> list[str]:
-        contents = []
+    @property
+    def documents(self) -> DocumentStore:
+        return REGISTRY.get("documents", DocumentStore)
 
-        for name in source_names:
-            content = load(os.path.join(self.folder_path, name + ".txt"))
-
-            contents.append(name + "\n" + content)
+    def _build_sources(
+        self, query: str, scored_docs: list[tuple[str, float]]
+    ) -> list[str]:
+        source_names = [x for x, _ in scored_docs]
+        return self.context.build(query, self._retrieve_docs(source_names))
 
-        return contents
+    def _retrieve_docs(self, source_names: list[str]) -> list[str]:
+        return [
+            name + "\n" + content
+            for name, content in zip(source_names, self.documents.get_many(source_names))
+        ]
@@ -1,30 +1,323 @@
 import json
-import os
+import queue
+import threading
 import time
-from threading import Thread
+from collections import OrderedDict
 
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
+from transformers.generation.streamers import BaseStreamer
 
+from src.context import ContextBuilder
+from src.document_store import DocumentStore
 from src.rag import get_prompt
-from src.utils import from_current_file, load
+from src.registry import REGISTRY
+from src.timing import TIMER
+
+
+class GenerationRequest:
+    __slots__ = ("prompt", "streamer", "error")
+
+    def __init__(self, prompt: str, streamer: TextIteratorStreamer):
+        self.prompt = prompt
+        self.streamer = streamer
+        self.error: BaseException | None = None
+
+
+# Hands the tokens of a batched `generate` call to the streamer of each request. A row
+# is closed as soon as it emits the end of sequence token, the others keep streaming
+class BatchStreamer(BaseStreamer):
+    def __init__(self, requests: list[GenerationRequest], eos_token_id: int | None):
+        self.requests = requests
+        self.eos_token_id = eos_token_id
+        self.finished = [False] * len(requests)
+        self.tokens = 0
+        self._prompt_skipped = False
+
+    def put(self, value: torch.Tensor):
+        # The first call holds the (padded) prompts
+        if not self._prompt_skipped:
+            self._prompt_skipped = True
+            return
+        for i, token in enumerate(value.reshape(len(self.requests), -1)):
+            if self.finished[i]:
+                continue
+            self.requests[i].streamer.put(token)
+            self.tokens += len(token)
+            if self.eos_token_id is not None and token[-1].item() == self.eos_token_id:
+                self.finished[i] = True
+                self.requests[i].streamer.end()
+
+    def end(self):
+        for i, request in enumerate(self.requests):
+            if not self.finished[i]:
+                self.finished[i] = True
+                request.streamer.end()
+
+
+# Runs all generations of a model on a single thread. Prompts that arrive while a batch
+# is generating (or within `batch_wait` seconds of the first one) are left-padded and
+# generated together in the next batch, so concurrent requests share forward passes
+# instead of competing for the same cores
+class GenerationScheduler:
+    def __init__(
+        self,
+        name: str,
+        tokenizer,
+        model,
+        device: torch.device,
+        max_new_tokens: int,
+        max_batch_size: int = 8,
+        batch_wait: float = 0.01,
+    ):
+        self.name = name
+        self.tokenizer = tokenizer
+        self.model = model
+        self.device = device
+        self.max_new_tokens = max_new_tokens
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait  # seconds
+
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        self.batches = 0
+        self.requests = 0
+        self.tokens = 0
+        self.busy_time = 0.0  # seconds spent generating
+        self.last_batch_size = 0
+        self.max_seen_batch_size = 0
+
+        self._queue: queue.Queue[GenerationRequest | None] = queue.Queue()
+        # Nothing is queued after the closing sentinel, it would never be generated
+        self._closed = False
+        self._submit_lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, name=f"generation-{name}", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, prompt: str) -> GenerationRequest:
+        request = GenerationRequest(
+            prompt, TextIteratorStreamer(self.tokenizer, skip_prompt=False)
+        )
+        with self._submit_lock:
+            if self._closed:
+                raise RuntimeError(f"Local model '{self.name}' was unloaded")
+            self._queue.put(request)
+        return request
+
+    def close(self):
+        # Requests already queued are still generated
+        with self._submit_lock:
+            self._closed = True
+            self._queue.put(None)
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "batches": self.batches,
+            "requests": self.requests,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_seen_batch_size,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "tokens": self.tokens,
+            "tokens_per_second": self.tokens / self.busy_time if self.busy_time else 0.0,
+        }
+
+    def _run(self):
+        closed = False
+        while not closed:
+            request = self._queue.get()
+            if request is None:
+                return
+            batch = [request]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    closed = True
+                    break
+                batch.append(request)
+            self._generate(batch)
+
+    def _generate(self, batch: list[GenerationRequest]):
+        start = time.perf_counter()
+        streamer = BatchStreamer(batch, self.tokenizer.eos_token_id)
+        try:
+            inputs = self.tokenizer(
+                [request.prompt for request in batch], return_tensors="pt", padding=True
+            ).to(self.device)
+            with torch.inference_mode():
+                self.model.generate(
+                    **inputs,
+                    streamer=streamer,
+                    max_new_tokens=self.max_new_tokens,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                )
+        except Exception as e:
+            for request in batch:
+                request.error = e
+        finally:
+            self.batches += 1
+            self.requests += len(batch)
+            self.tokens += streamer.tokens
+            self.busy_time += time.perf_counter() - start
+            self.last_batch_size = len(batch)
+            self.max_seen_batch_size = max(self.max_seen_batch_size, len(batch))
+            streamer.end()
+
+
+class LoadedModel:
+    __slots__ = ("name", "tokenizer", "model", "memory", "scheduler")
+
+    def __init__(
+        self, name: str, tokenizer, model, memory: int, scheduler: GenerationScheduler
+    ):
+        self.name = name
+        self.tokenizer = tokenizer
+        self.model = model
+        self.memory = memory  # bytes taken by parameters and buffers
+        self.scheduler = scheduler
+
+
+# Keeps loaded local models warm between requests. Models are loaded once, either at
+# startup (`preload`) or on first use, and the least recently used ones are dropped
+# when the total size of loaded models exceeds `memory_budget`
+class LocalModelPool:
+    def __init__(
+        self,
+        device: torch.device,
+        max_new_tokens: int,
+        memory_budget: int | None = None,
+        quantize: bool = False,
+        max_batch_size: int = 8,
+        batch_wait: float = 0.01,
+    ):
+        self.device = device
+        self.max_new_tokens = max_new_tokens
+        self.memory_budget = memory_budget  # bytes, None for no limit
+        # Dynamic int8 quantization of linear layers, only applied on CPU
+        self.quantize = quantize and device.type == "cpu"
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+
+        self._models: OrderedDict[str, LoadedModel] = OrderedDict()
+        # Reentrant: `submit` reloads evicted models through `get`
+        self._lock = threading.RLock()
+
+    def get(self, model_name: str) -> LoadedModel:
+        with self._lock:
+            loaded = self._models.get(model_name)
+            if loaded is None:
+                loaded = self._load(model_name)
+                self._models[model_name] = loaded
+                self._evict(keep=model_name)
+            self._models.move_to_end(model_name)
+            return loaded
+
+    def submit(self, loaded: LoadedModel, prompt: str) -> GenerationRequest:
+        # Queued under the pool lock, so the model can not be evicted in between. A
+        # model evicted since `get` (while the context was built) is loaded again
+        with self._lock:
+            if self._models.get(loaded.name) is not loaded:
+                loaded = self.get(loaded.name)
+            return loaded.scheduler.submit(prompt)
+
+    def preload(self, model_names: list[str]):
+        for model_name in model_names:
+            self.get(model_name)
+
+    def loaded(self) -> dict[str, int]:
+        return {name: loaded.memory for name, loaded in self._models.items()}
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            name: {"memory": loaded.memory, **loaded.scheduler.stats()}
+            for name, loaded in self._models.items()
+        }
+
+    def _load(self, model_name: str) -> LoadedModel:
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModelForCausalLM.from_pretrained(model_name)
+        model.eval()
+        if self.quantize:
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        model = model.to(self.device)
+
+        scheduler = GenerationScheduler(
+            model_name,
+            tokenizer,
+            model,
+            self.device,
+            self.max_new_tokens,
+            max_batch_size=self.max_batch_size,
+            batch_wait=self.batch_wait,
+        )
+        return LoadedModel(
+            model_name, tokenizer, model, self._model_memory(model), scheduler
+        )
+
+    def _model_memory(self, model) -> int:
+        tensors = [*model.parameters(), *model.buffers()]
+        # Quantized weights are packed, they are not listed as parameters
+        for module in model.modules():
+            if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+                tensors.append(module.weight())
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+    def _evict(self, keep: str):
+        if self.memory_budget is None:
+            return
+        # Generations in progress (and already queued) keep their model alive until
+        # they finish
+        while sum(self.loaded().values()) > self.memory_budget:
+            name = next((name for name in self._models if name != keep), None)
+            if name is None:
+                break
+            print(f"Evicting local model '{name}'")
+            self._models.pop(name).scheduler.close()
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
 
 
 class RetrievalAugmentedGenerationLocal:
-    folder_path = from_current_file("../data/scrapped/class_data_function__1_1")
     max_tokens: int = 256
 
-    def __init__(self):
+    def __init__(
+        self,
+        preload: list[str] | None = None,
+        memory_budget_mb: float | None = None,
+        quantize: bool = False,
+        max_batch_size: int = 8,
+        batch_wait_ms: float = 10,
+        context_tokens: int = 3000,
+    ):
+        self.context = ContextBuilder(context_tokens)
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.pool = LocalModelPool(
+            self.device,
+            self.max_tokens,
+            memory_budget=int(memory_budget_mb * 2**20) if memory_budget_mb else None,
+            quantize=quantize,
+            max_batch_size=max_batch_size,
+            batch_wait=batch_wait_ms / 1e3,
+        )
+        if preload:
+            self.pool.preload(preload)
 
     def generate_stream(
         self, query: str, model_name: str, scored_docs: list[tuple[str, float]]
     ):
         start = time.time()
+        time_to_first_token = None
         source_names = [x for x, _ in scored_docs]
-        sources = self._retrieve_docs(source_names)
-
-        prompt = get_prompt(query, sources)
 
         yield (
             json.dumps(
@@ -37,39 +330,54 @@ class RetrievalAugmentedGenerationLocal:
         )
 
         try:
-            tokenizer = AutoTokenizer.from_pretrained(model_name)
-            model = AutoModelForCausalLM.from_pretrained(model_name)
-            model.eval()
-
-            model = model.to(self.device)
-
-            input_ids = tokenizer.encode(prompt, return_tensors="pt").to(self.device)
-
-            streamer = TextIteratorStreamer(tokenizer, skip_prompt=True)
-
-            generation_kwargs = {
-                "input_ids": input_ids,
-                "streamer": streamer,
-                "max_new_tokens": self.max_tokens,
-                "pad_token_id": tokenizer.eos_token_id,
-            }
+            loaded = self.pool.get(model_name)
+            sources = self.context.build(
+                query,
+                self._retrieve_docs(source_names),
+                tokenizer=loaded.tokenizer,
+                token_budget=self._context_budget(loaded, query),
+            )
+            prompt = get_prompt(query, sources)
 
-            thread = Thread(target=model.generate, kwargs=generation_kwargs)
-            thread.start()
-            for new_token in streamer:
+            request = self.pool.submit(loaded, prompt)
+            for new_token in request.streamer:
+                if time_to_first_token is None and new_token:
+                    time_to_first_token = time.time() - start
+                    TIMER.observe("llm_time_to_first_token", time_to_first_token)
                 yield (json.dumps({"type": "chunk", "data": new_token}) + "\n\n")
+            if request.error is not None:
+                raise request.error
 
         except BaseException as e:
             yield json.dumps({"type": "error", "data": str(e)}) + "\n\n"
 
-        yield (json.dumps({"type": "complete", "data": time.time() - start}) + "\n\n")
-
-    def _retrieve_docs(self, source_names: list[str]) -> list[str]:
-        contents = []
+        total = time.time() - start
+        TIMER.observe("llm_generation", total)
+        yield (
+            json.dumps(
+                {
+                    "type": "complete",
+                    "data": total,
+                    "time_to_first_token": time_to_first_token,
+                }
+            )
+            + "\n\n"
+        )
 
-        for name in source_names:
-            content = load(os.path.join(self.folder_path, name + ".txt"))
+    def _context_budget(self, loaded: LoadedModel, query: str) -> int:
+        # The prompt and the generated tokens have to fit into the context window
+        window = getattr(loaded.model.config, "max_position_embeddings", None)
+        if window is None:
+            window = loaded.tokenizer.model_max_length
+        template = self.context.count_tokens(get_prompt(query, []), loaded.tokenizer)
+        return min(self.context.token_budget, window - self.max_tokens - template)
 
-            contents.append(name + "\n" + content)
+    @property
+    def documents(self) -> DocumentStore:
+        return REGISTRY.get("documents", DocumentStore)
 
-        return contents
+    def _retrieve_docs(self, source_names: list[str]) -> list[str]:
+        return [
+            name + "\n" + content
+            for name, content in zip(source_names, self.documents.get_many(source_names))
+        ]
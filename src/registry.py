@@ -0,0 +1,83 @@
+import os
+import resource
+import sys
+import threading
+import time
+from typing import Any, Callable
+
+
+def get_memory_usage() -> int:
+    # Resident set size of the process, in bytes
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak RSS, reported in bytes on macOS and in kilobytes elsewhere
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+# Process-wide owner of heavy components (indexes, models). Every component is loaded
+# once, on first use (or on `preload`), and shared by all pipelines. Indexes keep their
+# large arrays memory-mapped, so the OS page cache is also shared between worker
+# processes
+class ComponentRegistry:
+    def __init__(self):
+        self._factories: dict[str, Callable[[], Any]] = {}
+        self._components: dict[str, Any] = {}
+        # {name: {"load_time": seconds, "memory": bytes}}
+        self._stats: dict[str, dict[str, float]] = {}
+        # Reentrant: a component may load the components it depends on
+        self._lock = threading.RLock()
+
+    def register(self, name: str, factory: Callable[[], Any]):
+        # The first registration wins, so every pipeline can declare what it needs
+        with self._lock:
+            self._factories.setdefault(name, factory)
+
+    def get(self, name: str, factory: Callable[[], Any] | None = None) -> Any:
+        component = self._components.get(name)
+        if component is not None:
+            return component
+
+        with self._lock:
+            if factory is not None:
+                self.register(name, factory)
+            if name in self._components:
+                return self._components[name]
+            if name not in self._factories:
+                raise RuntimeError(f"Unknown component '{name}'")
+
+            print(f"Loading {name}...")
+            memory = get_memory_usage()
+            start = time.perf_counter()
+            component = self._factories[name]()
+            self._stats[name] = {
+                "load_time": time.perf_counter() - start,
+                "memory": get_memory_usage() - memory,
+            }
+            self._components[name] = component
+            print(
+                f"Loaded {name} in {self._stats[name]['load_time']:.2f}s"
+                f" (+{self._stats[name]['memory'] / 2**20:.1f} MB)"
+            )
+            return component
+
+    def peek(self, name: str) -> Any | None:
+        # The component if it is already loaded, without loading it
+        return self._components.get(name)
+
+    def preload(self, names: list[str] | None = None):
+        for name in names if names is not None else list(self._factories):
+            self.get(name)
+
+    def report(self) -> dict[str, dict]:
+        # Load time and memory of components loaded by the ones they depend on are
+        # included in the figures of the latter
+        return {
+            name: {"loaded": name in self._components, **self._stats.get(name, {})}
+            for name in self._factories
+        }
+
+
+REGISTRY = ComponentRegistry()
@@ -1,41 +1,211 @@
+import argparse
+import asyncio
+import hashlib
 import os
+import random
+import time
 import typing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
 from typing import Callable, Literal
 
-import requests
+import httpx
 from bs4 import BeautifulSoup as bs
 from tqdm import tqdm
 
-from src.utils import from_current_file, load_json, save_json
+from src.utils import from_current_file, load, load_json, save, save_json
 
 # Documentation links
-DOCS_INDEX_URL = "https://docs.python.org/3.12/py-modindex.html"
+DOCS_INDEX_PAGE = "py-modindex.html"
 DOCS_URL_PREFIX = "https://docs.python.org/3.12/"
+DOCS_INDEX_URL = f"{DOCS_URL_PREFIX}{DOCS_INDEX_PAGE}"
 
 # FileSystem paths
 SAVE_FOLDER = from_current_file("../data/scrapped")
+HTTP_CACHE_FOLDER = from_current_file("../data/scrapped/http_cache")
 
+# Parser used by BeautifulSoup, much faster than "html.parser"
+HTML_PARSER = "lxml"
 
-def load_context(url: str) -> bs:
-    response = requests.get(url)
+# Responses worth retrying
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+ElementType = Literal["class", "function", "exception", "data"]
+Document = tuple[str, str]  # (name, content)
+
+
+def run_sync(coroutine: typing.Coroutine):
+    # `asyncio.run` can not be called from a running event loop (notebooks, servers)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def rebase_url(url: str, base_url: str) -> str:
+    # Links are saved against the official documentation, pages may be served elsewhere
+    # (a mirror, or a local server with saved pages)
+    if url.startswith(DOCS_URL_PREFIX):
+        return base_url + url.removeprefix(DOCS_URL_PREFIX)
+    return url
+
+
+# ETag/Last-Modified validators and bodies of fetched pages, so unchanged pages are
+# answered with "304 Not Modified" and read from disk on later runs
+class HttpCache:
+    def __init__(self, path: Path = HTTP_CACHE_FOLDER):
+        self._path = path
+        os.makedirs(self._path, exist_ok=True)
+
+    def _paths(self, url: str) -> tuple[str, str]:
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return (
+            os.path.join(self._path, f"{key}.json"),
+            os.path.join(self._path, f"{key}.html"),
+        )
+
+    def headers(self, url: str) -> dict[str, str]:
+        meta_path, body_path = self._paths(url)
+        if not os.path.exists(meta_path) or not os.path.exists(body_path):
+            return {}
+        meta = load_json(meta_path)
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def get(self, url: str) -> str:
+        return load(self._paths(url)[1])
+
+    def set(self, url: str, response: httpx.Response):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            return
+        meta_path, body_path = self._paths(url)
+        save(body_path, response.text)
+        save_json(meta_path, {"url": url, "etag": etag, "last_modified": last_modified})
+
+
+# Fetches pages over a pooled connection: at most `concurrency` requests in flight, at
+# most `rate_limit` request starts per second, failed requests (network errors, 429
+# and 5xx) retried with exponential backoff and jitter
+class PageFetcher:
+    def __init__(
+        self,
+        concurrency: int = 8,
+        rate_limit: float | None = None,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 30.0,
+        cache: HttpCache | None = None,
+    ):
+        self.concurrency = concurrency
+        self.rate_limit = rate_limit  # requests per second, None for no limit
+        self.retries = retries
+        self.backoff = backoff  # seconds, doubled on each retry
+        self.timeout = timeout
+        self.cache = cache
+
+        self.stats = {"requests": 0, "not_modified": 0, "retries": 0, "failed": 0}
+
+        self._client: httpx.AsyncClient | None = None
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._rate_lock = asyncio.Lock()
+        self._next_request_at = 0.0
+
+    async def __aenter__(self) -> "PageFetcher":
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.concurrency,
+                max_keepalive_connections=self.concurrency,
+            ),
+            timeout=self.timeout,
+            follow_redirects=True,
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def fetch(self, url: str) -> str:
+        if self._client is None:
+            raise RuntimeError("PageFetcher must be used as an async context manager")
+
+        headers = self.cache.headers(url) if self.cache is not None else {}
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                await self._wait_rate_limit()
+                self.stats["requests"] += 1
+                delay = self.backoff * 2**attempt + random.uniform(0, self.backoff)
+                try:
+                    response = await self._client.get(url, headers=headers)
+                except httpx.TransportError as e:
+                    error: Exception = e
+                else:
+                    if response.status_code == 304 and self.cache is not None:
+                        self.stats["not_modified"] += 1
+                        return self.cache.get(url)
+                    if response.status_code == 200:
+                        if self.cache is not None:
+                            self.cache.set(url, response)
+                        return response.text
+                    error = RuntimeError(f"Response code is {response.status_code}")
+                    if response.status_code not in RETRY_STATUS_CODES:
+                        break
+                    retry_after = response.headers.get("Retry-After", "")
+                    if retry_after.isdigit():
+                        delay = max(delay, float(retry_after))
+                if attempt < self.retries:
+                    self.stats["retries"] += 1
+                    await asyncio.sleep(delay)
+
+        self.stats["failed"] += 1
+        raise RuntimeError(f"Failed to fetch '{url}': {error}") from error
+
+    async def _wait_rate_limit(self):
+        if not self.rate_limit:
+            return
+        async with self._rate_lock:
+            now = time.monotonic()
+            delay = self._next_request_at - now
+            self._next_request_at = max(now, self._next_request_at) + 1 / self.rate_limit
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def load_context(url: str, timeout: float = 30.0) -> bs:
+    response = httpx.get(url, timeout=timeout, follow_redirects=True)
     if response.status_code == 200:
-        return bs(response.text, "html.parser")
+        return bs(response.text, HTML_PARSER)
     raise RuntimeError(f"Response code is {response.status_code}")
 
 
 class ModulesIndex:
     def __init__(
-        self, skip_platform_specific: bool = True, skip_deprecated: bool = True
+        self,
+        skip_platform_specific: bool = True,
+        skip_deprecated: bool = True,
+        base_url: str = DOCS_URL_PREFIX,
+        save_folder: Path = SAVE_FOLDER,
     ) -> None:
         self._skip_platform_specific = skip_platform_specific
         self._skip_deprecated = skip_deprecated
+        self._base_url = base_url
+        self._save_folder = save_folder
 
         self._name = "index"
         self._settings = (
             f"{int(self._skip_platform_specific)}_{int(self._skip_deprecated)}"
         )
         self._path = os.path.join(
-            SAVE_FOLDER,
+            self._save_folder,
             f"{self._name}_{self._settings}.json",
         )
 
@@ -45,8 +215,8 @@ class ModulesIndex:
         if os.path.exists(self._path):
             self._data = load_json(self._path)
             return
-        os.makedirs(SAVE_FOLDER, exist_ok=True)
-        self._data = self._scrap(load_context(DOCS_INDEX_URL))
+        os.makedirs(self._save_folder, exist_ok=True)
+        self._data = self._scrap(load_context(f"{self._base_url}{DOCS_INDEX_PAGE}"))
         save_json(self._path, self._data)
 
     def _scrap(self, soup: bs) -> dict[str, dict[str, str]]:
@@ -80,6 +250,7 @@ class ModulesIndex:
             if self._skip_deprecated and desc.startswith("Deprecated"):
                 continue
 
+            # Saved against the official documentation, see `rebase_url`
             data[module_name] = {
                 "link": f"{DOCS_URL_PREFIX}{module_ref}",
                 "description": desc,
@@ -98,39 +269,185 @@ class ModulesIndex:
         return len(self._data)
 
 
+def _basic_handler(
+    module_name: str, context: bs, element_type: ElementType
+) -> list[Document]:
+    documents = []
+    for element in context.select(f".py.{element_type}"):
+        if element.select_one("dd>div.deprecated"):
+            continue
+        description = "\n".join(
+            [x.text.strip() for x in element.select("dd>p, dd>div>p")]
+        )
+        for object in element.select("dt.sig-object"):
+            # Name
+            pre_names = object.select("span.sig-prename")
+            pre_name = (
+                "".join([x.text.strip() for x in pre_names]) if len(pre_names) > 0 else ""
+            )
+            name = object.select_one("span.sig-name")
+
+            if name is None:
+                continue
+            full_name = f"{pre_name}{name.text.strip()}"
+
+            # Parameters
+            parameters_info = ""
+            params = [x.text for x in object.select("em.sig-param")]
+            if len(params) > 0:
+                parameters_info = ", ".join(params)
+
+            parameters_section = (
+                f"PARAMETERS\n{parameters_info}\n\n" if parameters_info != "" else ""
+            )
+
+            documents.append(
+                (
+                    full_name,
+                    f"{element_type.upper()}\n\n{full_name} FROM {module_name}\n\n{parameters_section}DESCRIPTION\n{description}",
+                )
+            )
+    return documents
+
+
+def _handle_data(module_name: str, context: bs) -> list[Document]:
+    return _basic_handler(module_name, context, "data")
+
+
+def _handle_function(module_name: str, context: bs) -> list[Document]:
+    return _basic_handler(module_name, context, "function")
+
+
+def _handle_class(module_name: str, context: bs) -> list[Document]:
+    documents = []
+    for element in context.select(".py.class"):
+        if element.select_one("dd>div.deprecated"):
+            continue
+
+        description = "\n".join(
+            [x.text.strip() for x in element.select("dd>p, dd>div>p")]
+        )
+
+        object = element.select_one("dt.sig-object")
+
+        if object is None:
+            continue
+        # Name
+        specification_obj = object.select_one("span.pre")
+        specification = (
+            specification_obj.text.strip() if specification_obj is not None else "class"
+        )
+        pre_names = object.select("span.sig-prename")
+        pre_name = (
+            "".join([x.text.strip() for x in pre_names]) if len(pre_names) > 0 else ""
+        )
+        name = object.select_one("span.sig-name")
+
+        if name is None:
+            continue
+        full_name = f"{pre_name}{name.text.strip()}"
+
+        documents.append(
+            (
+                full_name,
+                f"{specification.upper()}\n\n{full_name} FROM {module_name}\n\nDESCRIPTION\n{description}",
+            )
+        )
+
+        for method_object in element.select("dd>dl.py.method"):
+            if method_object.select_one("dd>div.deprecated"):
+                continue
+
+            # Description
+            method_description = "\n".join(
+                [x.text.strip() for x in method_object.select("dd>p, dd>div>p")]
+            )
+
+            # Name
+            method_name_obj = method_object.select_one("dt.sig-object>span.sig-name")
+
+            if method_name_obj is None:
+                continue
+            method_name = method_name_obj.text.strip()
+            method_full_name = f"{full_name}.{method_name}"
+
+            # Parameters
+            parameters_info = ""
+            params = [x.text for x in method_object.select("em.sig-param")]
+            if len(params) > 0:
+                parameters_info = ", ".join(params)
+
+            parameters_section = (
+                f"PARAMETERS\n{parameters_info}\n\n" if parameters_info != "" else ""
+            )
+
+            documents.append(
+                (
+                    method_full_name,
+                    f"METHOD OF {full_name}\n\n{method_full_name} FROM {module_name}\n\n{parameters_section}DESCRIPTION\n{method_description}",
+                )
+            )
+    return documents
+
+
+SELECTOR_HANDLERS: dict[ElementType, Callable[[str, bs], list[Document]]] = {
+    "class": _handle_class,
+    "function": _handle_function,
+    # "exception": _handle_exception,
+    "data": _handle_data,
+}
+
+
+def parse_module_page(
+    module_name: str, html: str, selectors: list[ElementType]
+) -> list[Document]:
+    # Runs in a worker process: parsing is CPU-bound
+    context = bs(html, HTML_PARSER)
+    documents = []
+    for selector in selectors:
+        documents.extend(SELECTOR_HANDLERS[selector](module_name, context))
+    return documents
+
+
 class ModulesScrapper:
-    ElementType = Literal["class", "function", "exception", "data"]
+    ElementType = ElementType
     valid_types: list[ElementType] = list(typing.get_args(ElementType))
 
     def __init__(
         self,
         modules_index: ModulesIndex,
         include: list[ElementType] = ["class", "function", "data"],
+        base_url: str = DOCS_URL_PREFIX,
+        concurrency: int = 8,
+        rate_limit: float | None = None,
+        parse_workers: int | None = None,
+        save_folder: Path = SAVE_FOLDER,
+        http_cache: HttpCache | None = None,
     ) -> None:
-        self._selector_handlers: dict[
-            ModulesScrapper.ElementType, Callable[[str, bs], None]
-        ] = {
-            "class": self._handle_class,
-            "function": self._handle_function,
-            # "exception": self._handle_exception,
-            "data": self._handle_data,
-        }
-
         self._selectors = include
         if len(self._selectors) == 0:
             raise RuntimeError("Selector is empty!")
 
         for t in self._selectors:
-            if t not in self.valid_types:
+            if t not in self.valid_types or t not in SELECTOR_HANDLERS:
                 raise RuntimeError(f"Selector {t} is invalid!")
 
         self._modules_index = modules_index
         self._length = 0
+        self._base_url = base_url
+        self._concurrency = concurrency
+        self._rate_limit = rate_limit
+        self._parse_workers = parse_workers
+        self._http_cache = (
+            http_cache
+            if http_cache is not None
+            else HttpCache(os.path.join(save_folder, "http_cache"))
+        )
 
         self._name = (
             f"{'_'.join(sorted(self._selectors))}__{self._modules_index.settings}"
         )
-        self._path = os.path.join(SAVE_FOLDER, self._name)
+        self._path = os.path.join(save_folder, self._name)
         os.makedirs(self._path, exist_ok=True)
 
     def _save(self, name: str, data: str):
@@ -144,143 +461,140 @@ class ModulesScrapper:
         except OSError:
             pass
 
-    def _basic_handler(self, module_name: str, context: bs, element_type: ElementType):
-        for element in context.select(f".py.{element_type}"):
-            if element.select_one("dd>div.deprecated"):
-                continue
-            description = "\n".join(
-                [x.text.strip() for x in element.select("dd>p, dd>div>p")]
-            )
-            for object in element.select("dt.sig-object"):
-                # Name
-                pre_names = object.select("span.sig-prename")
-                pre_name = (
-                    "".join([x.text.strip() for x in pre_names])
-                    if len(pre_names) > 0
-                    else ""
-                )
-                name = object.select_one("span.sig-name")
-
-                if name is None:
-                    continue
-                full_name = f"{pre_name}{name.text.strip()}"
-
-                # Parameters
-                parameters_info = ""
-                params = [x.text for x in object.select("em.sig-param")]
-                if len(params) > 0:
-                    parameters_info = ", ".join(params)
-
-                parameters_section = (
-                    f"PARAMETERS\n{parameters_info}\n\n" if parameters_info != "" else ""
-                )
-
-                # Save
-                self._save(
-                    full_name,
-                    f"{element_type.upper()}\n\n{full_name} FROM {module_name}\n\n{parameters_section}DESCRIPTION\n{description}",
-                )
-
-    def _handle_data(self, module_name: str, context: bs):
-        self._basic_handler(module_name, context, "data")
-
-    def _handle_function(self, module_name: str, context: bs):
-        self._basic_handler(module_name, context, "function")
-
-    def _handle_class(self, module_name: str, context: bs):
-        for element in context.select(".py.class"):
-            if element.select_one("dd>div.deprecated"):
-                continue
-
-            description = "\n".join(
-                [x.text.strip() for x in element.select("dd>p, dd>div>p")]
-            )
-
-            object = element.select_one("dt.sig-object")
-
-            if object is None:
-                continue
-            # Name
-            specification_obj = object.select_one("span.pre")
-            specification = (
-                specification_obj.text.strip()
-                if specification_obj is not None
-                else "class"
-            )
-            pre_names = object.select("span.sig-prename")
-            pre_name = (
-                "".join([x.text.strip() for x in pre_names]) if len(pre_names) > 0 else ""
-            )
-            name = object.select_one("span.sig-name")
-
-            if name is None:
-                continue
-            full_name = f"{pre_name}{name.text.strip()}"
-
-            # Save
-            self._save(
-                full_name,
-                f"{specification.upper()}\n\n{full_name} FROM {module_name}\n\nDESCRIPTION\n{description}",
-            )
-
-            for method_object in element.select("dd>dl.py.method"):
-                if method_object.select_one("dd>div.deprecated"):
-                    continue
-
-                # Description
-                method_description = "\n".join(
-                    [x.text.strip() for x in method_object.select("dd>p, dd>div>p")]
-                )
-
-                # Name
-                method_name_obj = method_object.select_one("dt.sig-object>span.sig-name")
-
-                if method_name_obj is None:
-                    continue
-                method_name = method_name_obj.text.strip()
-                method_full_name = f"{full_name}.{method_name}"
-
-                # Parameters
-                parameters_info = ""
-                params = [x.text for x in method_object.select("em.sig-param")]
-                if len(params) > 0:
-                    parameters_info = ", ".join(params)
-
-                parameters_section = (
-                    f"PARAMETERS\n{parameters_info}\n\n" if parameters_info != "" else ""
-                )
-
-                # Save
-                self._save(
-                    method_full_name,
-                    f"METHOD OF {full_name}\n\n{method_full_name} FROM {module_name}\n\n{parameters_section}DESCRIPTION\n{method_description}",
-                )
-
-    def _scrap_and_save(self):
-        modules_data = self._modules_index.data
-        for module_name, info in tqdm(
-            modules_data.items(), desc="Scrapping", total=len(modules_data)
-        ):
-            module_context = load_context(info["link"])
+    async def _scrap_and_save(self) -> dict[str, int | float]:
+        start = time.perf_counter()
+        modules = list(self._modules_index.data.items())
+        # Several modules may be documented on the same page, which is fetched once
+        pages = {
+            rebase_url(info["link"], self._base_url).split("#")[0] for _, info in modules
+        }
+        loop = asyncio.get_running_loop()
+
+        async with PageFetcher(
+            concurrency=self._concurrency,
+            rate_limit=self._rate_limit,
+            cache=self._http_cache,
+        ) as fetcher:
+            fetched = {url: asyncio.ensure_future(fetcher.fetch(url)) for url in pages}
+
+            with ProcessPoolExecutor(max_workers=self._parse_workers) as executor:
+
+                async def scrap_module(module_name: str, url: str) -> list[Document]:
+                    html = await fetched[url]
+                    return await loop.run_in_executor(
+                        executor, parse_module_page, module_name, html, self._selectors
+                    )
+
+                tasks = [
+                    asyncio.ensure_future(
+                        scrap_module(
+                            module_name,
+                            rebase_url(info["link"], self._base_url).split("#")[0],
+                        )
+                    )
+                    for module_name, info in modules
+                ]
+                try:
+                    for task in tqdm(
+                        asyncio.as_completed(tasks), desc="Scrapping", total=len(tasks)
+                    ):
+                        await task
+                finally:
+                    for task in [*tasks, *fetched.values()]:
+                        task.cancel()
+
+        # Saved in the order of the index, so that documents with the same name are
+        # resolved as in a sequential run
+        for task in tasks:
+            for name, content in task.result():
+                self._save(name, content)
+
+        elapsed = time.perf_counter() - start
+        stats = {
+            "pages": len(pages),
+            "modules": len(modules),
+            **fetcher.stats,
+            "seconds": elapsed,
+            "pages_per_second": len(pages) / elapsed if elapsed > 0 else 0.0,
+        }
+        print(
+            f"Scrapped {stats['pages']} pages ({stats['modules']} modules) in"
+            f" {elapsed:.1f}s: {stats['pages_per_second']:.1f} pages/s,"
+            f" {stats['not_modified']} not modified, {stats['retries']} retries"
+        )
+        return stats
 
-            for selector in self._selectors:
-                self._selector_handlers[selector](module_name, module_context)
+    async def load_async(self, force: bool = False):
+        if force or (not os.path.exists(self._path) or len(os.listdir(self._path)) == 0):
+            await self._scrap_and_save()
+        self._length = len(os.listdir(self._path))
 
     def load(
         self,
         force: bool = False,
     ):
-        if force or (not os.path.exists(self._path) or len(os.listdir(self._path)) == 0):
-            self._scrap_and_save()
-        self._length = len(os.listdir(self._path))
+        run_sync(self.load_async(force=force))
 
     def __len__(self) -> int:
         return self._length
 
 
-def scrap(force: bool = False) -> int:
-    modules_index = ModulesIndex()
-    scrapper = ModulesScrapper(modules_index)
-    scrapper.load(force=force)
+async def scrap_async(
+    force: bool = False,
+    base_url: str = DOCS_URL_PREFIX,
+    concurrency: int = 8,
+    rate_limit: float | None = None,
+    save_folder: Path = SAVE_FOLDER,
+) -> int:
+    modules_index = ModulesIndex(base_url=base_url, save_folder=save_folder)
+    scrapper = ModulesScrapper(
+        modules_index,
+        base_url=base_url,
+        concurrency=concurrency,
+        rate_limit=rate_limit,
+        save_folder=save_folder,
+    )
+    await scrapper.load_async(force=force)
 
     return len(scrapper)
+
+
+def scrap(force: bool = False, **kwargs) -> int:
+    return run_sync(scrap_async(force=force, **kwargs))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scrap the Python documentation")
+    parser.add_argument("-f", "--force", action="store_true", help="scrap again")
+    parser.add_argument(
+        "--base-url",
+        default=DOCS_URL_PREFIX,
+        dest="base_url",
+        help="documentation root, e.g. a local server with saved pages",
+    )
+    parser.add_argument(
+        "-c", "--concurrency", type=int, default=8, help="requests in flight"
+    )
+    parser.add_argument(
+        "-r",
+        "--rate-limit",
+        type=float,
+        default=None,
+        dest="rate_limit",
+        help="max requests per second",
+    )
+    parser.add_argument(
+        "-o", "--output", type=Path, default=SAVE_FOLDER, help="folder to save into"
+    )
+    namespace = parser.parse_args()
+
+    print(
+        scrap(
+            force=namespace.force,
+            base_url=namespace.base_url,
+            concurrency=namespace.concurrency,
+            rate_limit=namespace.rate_limit,
+            save_folder=namespace.output,
+        ),
+        "documents",
+    )
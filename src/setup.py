@@ -6,15 +6,19 @@ import nltk
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 
-from bloom import BloomModerator
-from llm_indexer import LlmTreeIndexer
+from src.bloom import BloomModerator
+from src.ingestion import ingest
 from src.inverted_index import InvertedIndex
+from src.llm_indexer import LlmTreeIndexer
 from src.scrapper import ModulesIndex, ModulesScrapper
 from src.spellcheck import NorvigSpellCorrector
-from src.utils import load, save
+from src.utils import from_current_file, load, save
+from src.w2v_indexer import Word2VecIndexer
 
+DOCUMENTS_DIR = from_current_file("../data/scrapped/class_data_function__1_1")
 
-def setup_project(force: bool, skip_scrap: bool):
+
+def setup_project(force: bool, skip_scrap: bool, update: bool, workers: int | None):
     # Loading nltk data
     print("Start loading NLTK data...")
     nltk.download("stopwords")
@@ -29,25 +33,29 @@ def setup_project(force: bool, skip_scrap: bool):
         scrapper.load(force=force)
         print("Successfully finished scrapping!\n")
 
-    # Setup spell corrector
-    print("Building spell corrector...")
-    NorvigSpellCorrector(force=force)
-    print("Successfully built spell corrector!\n")
-
     # Setup Bloom Filter
     print("Building Bloom Filter...")
     BloomModerator(force=force)
     print("Successfully built Bloom Filter!\n")
 
-    # Setup Inverted Index
-    print("Building Inverted Index...")
-    InvertedIndex(force=force)
-    print("Successfully built Inverted Index!\n")
-
-    # Setup LLM Tree
-    print("Building LLM Tree...")
-    LlmTreeIndexer(force=force)
-    print("Successfully built LLM Tree!\n")
+    # Setup spell corrector, Inverted Index, LLM Tree and Word2Vec index: the corpus is
+    # read and tokenized once, in parallel, and streamed to the builders that need it
+    print("Building spell corrector, Inverted Index, LLM Tree and Word2Vec index...")
+    ingest(
+        DOCUMENTS_DIR,
+        [
+            lambda corpus: NorvigSpellCorrector(
+                force=force, update=update, corpus=corpus, build=True
+            ),
+            lambda corpus: InvertedIndex(force=force, update=update, corpus=corpus),
+            lambda corpus: LlmTreeIndexer(force=force, update=update, corpus=corpus),
+            lambda corpus: Word2VecIndexer(force=force, update=update, corpus=corpus),
+        ],
+        workers=workers,
+    )
+    print(
+        "Successfully built spell corrector, Inverted Index, LLM Tree and Word2Vec index!\n"
+    )
 
     # Create sample .env
     if not os.path.exists(".env"):
@@ -79,7 +87,28 @@ if __name__ == "__main__":
         help="should skip scrapping phase (default: False)",
     )
 
+    parser.add_argument(
+        "-u",
+        "--update",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+        help="incrementally apply added, changed and removed documents to existing indexes (default: False)",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default=None,
+        type=int,
+        help="processes reading and tokenizing the corpus (default: CPU count)",
+    )
+
     namespace = parser.parse_args()
-    (force, skip_scrap) = (namespace.force, namespace.skip_scrap)
+    (force, skip_scrap, update, workers) = (
+        namespace.force,
+        namespace.skip_scrap,
+        namespace.update,
+        namespace.workers,
+    )
 
-    setup_project(force, skip_scrap)
+    setup_project(force, skip_scrap, update, workers)
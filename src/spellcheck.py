@@ -1,18 +1,75 @@
+import math
 import os
 import re
 import string
-from collections import Counter, defaultdict
+import zlib
+from collections import Counter
 from pathlib import Path
+from typing import Iterable
 
+import numpy as np
 from nltk.corpus import stopwords
-from tqdm import tqdm
 
-from src.utils import from_current_file, load_json, remove_path, save_json
+from src.cache import TTLCache
+from src.ingestion import Document, read_corpus
+from src.manifest import DocumentManifest
+from src.timing import TIMER
+from src.utils import from_current_file, load_json, remove_path, save_array, save_json
+
+
+def generate_deletes(word: str, max_edits: int) -> set[str]:
+    # The word itself and every string obtained by deleting up to `max_edits` letters
+    deletes = {word}
+    level = {word}
+    for _ in range(max_edits):
+        level = {w[:i] + w[i + 1 :] for w in level for i in range(len(w))}
+        deletes |= level
+    return deletes
+
+
+def hash_delete(delete: str) -> int:
+    return zlib.crc32(delete.encode("utf-8"))
+
+
+def edit_distance(w1: str, w2: str, max_distance: int) -> int:
+    # Optimal string alignment distance (insertions, deletions, substitutions and
+    # transpositions of adjacent letters), or `max_distance + 1` if it is larger
+    if abs(len(w1) - len(w2)) > max_distance:
+        return max_distance + 1
+
+    # Common prefix and suffix do not change the distance
+    start = 0
+    while start < min(len(w1), len(w2)) and w1[start] == w2[start]:
+        start += 1
+    end = 0
+    while end < min(len(w1), len(w2)) - start and w1[-1 - end] == w2[-1 - end]:
+        end += 1
+    w1, w2 = w1[start : len(w1) - end], w2[start : len(w2) - end]
+    if not w1 or not w2:
+        return min(max(len(w1), len(w2)), max_distance + 1)
+
+    previous_row: list[int] = []
+    current_row = list(range(len(w2) + 1))
+    for i in range(1, len(w1) + 1):
+        previous_previous_row, previous_row = previous_row, current_row
+        current_row = [i] + [0] * len(w2)
+        for j in range(1, len(w2) + 1):
+            current_row[j] = min(
+                previous_row[j] + 1,
+                current_row[j - 1] + 1,
+                previous_row[j - 1] + (w1[i - 1] != w2[j - 1]),
+            )
+            if i > 1 and j > 1 and w1[i - 1] == w2[j - 2] and w1[i - 2] == w2[j - 1]:
+                current_row[j] = min(current_row[j], previous_previous_row[j - 2] + 1)
+        if min(current_row) > max_distance:
+            return max_distance + 1
+    return min(current_row[-1], max_distance + 1)
 
 
 class NorvigSpellCorrector:
-    letters = "abcdefghijklmnopqrstuvwxyz"
     _stop_words = set(stopwords.words("english"))
+    # Weight of the bigram estimate against the word frequency in context scoring
+    bigram_weight: float = 0.5
 
     def __init__(
         self,
@@ -21,26 +78,51 @@ class NorvigSpellCorrector:
             "../data/scrapped/class_data_function__1_1"
         ),
         max_edits: int = 2,
-        save_distances: bool = False,
         force: bool = False,
+        update: bool = False,
+        cache_size: int = 10000,
+        corpus: Iterable[Document] | None = None,
+        context: bool = True,
+        max_candidates: int = 8,
+        build: bool = False,
     ):
         self._max_edits = max_edits
-        self.save_distances = save_distances
+        # Correct queries as a whole, scoring candidate sequences with corpus bigrams
+        self.context = context
+        self.max_candidates = max_candidates  # candidates kept per word in context
+        # Memoized corrections of unknown words, they are costly to generate
+        self.corrections = TTLCache(maxsize=cache_size)
+        self.candidates = TTLCache(maxsize=cache_size)
+        self.version = 0  # bumped on every (re)load, so dependent caches can expire
 
         self._spell_dir = spell_dir
         self._documents_dir = documents_dir
 
         self._counter_path = os.path.join(self._spell_dir, "counter.json")
         self._settings_path = os.path.join(self._spell_dir, "settings.json")
+        self._documents_path = os.path.join(self._spell_dir, "documents.json")
+        self._bigrams_path = os.path.join(self._spell_dir, "bigrams.json")
+        self._document_bigrams_path = os.path.join(
+            self._spell_dir, "document_bigrams.json"
+        )
+        self._manifest_path = os.path.join(self._spell_dir, "manifest.json")
+        self._deletes_hashes_path = os.path.join(self._spell_dir, "deletes_hashes.npy")
+        self._deletes_word_ids_path = os.path.join(
+            self._spell_dir, "deletes_word_ids.npy"
+        )
 
         if force or not os.path.exists(self._spell_dir):
             remove_path(self._spell_dir)
             print("Spell index is not found, creating new...")
             os.mkdir(path=self._spell_dir)
-            self.build_index()
+            self.build_index(corpus)
             print("Complete!")
+        elif build:
+            self.build_missing(corpus)
 
         self.load_index()
+        if update:
+            self.update_index()
 
     def tokenize(self, text: str) -> list[str]:
         return re.findall(r"\w+", text.lower())
@@ -48,68 +130,148 @@ class NorvigSpellCorrector:
     def filter_stopwords(self, words: list[str]) -> list[str]:
         return [word for word in words if word not in self._stop_words]
 
-    def generate_edits(self, word: str) -> set[str]:
-        splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
-        deletes = [L + R[1:] for L, R in splits if R]
-        transposes = [L + R[1] + R[0] + R[2:] for L, R in splits if len(R) > 1]
-        replaces = [L + c + R[1:] for L, R in splits if R for c in self.letters]
-        inserts = [L + c + R for L, R in splits for c in self.letters]
-        return set(deletes + transposes + replaces + inserts)
-
-    def build_index(self):
-        # Words counter
-        words_counter = Counter(
-            self.filter_stopwords(
-                self.tokenize(
-                    " ".join(
-                        [
-                            re.sub(
-                                r"[^\x00-\x7F]+",
-                                " ",
-                                open(str(path), encoding="utf-8")
-                                .read()
-                                .lower()
-                                .replace("\n", " "),
-                            )
-                            for path in Path(self._documents_dir).rglob("*.txt")
-                        ]
-                    )
-                )
-            )
-        )
+    def _count_words(self, document: Document) -> Counter:
+        # Non-ASCII characters split words
+        return Counter(self.filter_stopwords(document.ascii_words))
+
+    def _count_bigrams(self, document: Document) -> Counter:
+        # Neighbours once stop words are removed, as queries are scored without them
+        words = self.filter_stopwords(document.ascii_words)
+        return Counter(f"{w1} {w2}" for w1, w2 in zip(words, words[1:]))
+
+    def _save_counters(
+        self,
+        document_counters: dict[str, Counter],
+        document_bigrams: dict[str, Counter],
+    ) -> Counter:
+        words_counter: Counter = Counter()
+        for counter in document_counters.values():
+            words_counter.update(counter)
+        bigrams_counter: Counter = Counter()
+        for counter in document_bigrams.values():
+            bigrams_counter.update(counter)
+        save_json(self._documents_path, document_counters)
+        save_json(self._document_bigrams_path, document_bigrams)
         save_json(self._counter_path, words_counter)
+        save_json(self._bigrams_path, bigrams_counter)
         settings = {"total": words_counter.total(), "max_edits": self._max_edits}
         save_json(self._settings_path, settings)
+        self._save_deletes(sorted(words_counter))
+        return words_counter
 
-        if self.save_distances:
-            edit_dicts = [defaultdict(set) for _ in range(self._max_edits)]
-            for word in tqdm(words_counter):
-                edits = {word}
-                for i in range(self._max_edits):
-                    temp_edits: set[str] = set()
-                    for w in edits:
-                        temp_edits.update(self.generate_edits(w))
-                        edit_dicts[i][w].add(word)
-                    edits = temp_edits
-
-            for idx in range(self._max_edits):
-                save_json(
-                    os.path.join(self._spell_dir, f"distance{idx + 1}"), edit_dicts[idx]
-                )
+    def _save_deletes(self, words: list[str]):
+        # Symmetric delete index: every deletion of up to `max_edits` letters of each
+        # word, stored as sorted 32-bit hashes next to the id (position in sorted
+        # vocabulary) of the word. A word within `max_edits` of a misspelling shares
+        # at least one deletion with it, so candidates are found by looking up the
+        # deletions of the misspelling only. Hash collisions only add candidates,
+        # which are verified anyway
+        hashes, word_ids = [], []
+        for word_id, word in enumerate(words):
+            deletes = generate_deletes(word, self._max_edits)
+            hashes.extend(hash_delete(delete) for delete in deletes)
+            word_ids.extend([word_id] * len(deletes))
+        hashes_array = np.array(hashes, dtype=np.uint32)
+        order = np.argsort(hashes_array, kind="stable")
+        save_array(self._deletes_hashes_path, hashes_array[order])
+        save_array(self._deletes_word_ids_path, np.array(word_ids, dtype=np.int32)[order])
+
+    def build_index(self, corpus: Iterable[Document] | None = None):
+        # Per-document counters are kept, so updates can subtract stale documents.
+        # `corpus` streams the documents when several builders share one corpus pass
+        document_counters, document_bigrams = {}, {}
+        for document in (
+            corpus if corpus is not None else read_corpus(self._documents_dir)
+        ):
+            document_counters[document.filename] = self._count_words(document)
+            document_bigrams[document.filename] = self._count_bigrams(document)
+        self._save_counters(document_counters, document_bigrams)
+        DocumentManifest(self._manifest_path, self._documents_dir).commit()
+
+    def build_missing(self, corpus: Iterable[Document] | None = None):
+        # Bigrams are counted from the corpus, the shipped spell directory has word
+        # counts only
+        if not os.path.exists(self._bigrams_path):
+            print("Spell bigrams are not found, rebuilding spell index...")
+            self.build_index(corpus)
+            return
+        # The delete index is derived from the word counts, so it is rebuilt without
+        # reading the corpus when it is missing or built for other `max_edits`
+        settings = load_json(self._settings_path)
+        if settings["max_edits"] != self._max_edits or not (
+            os.path.exists(self._deletes_hashes_path)
+            and os.path.exists(self._deletes_word_ids_path)
+        ):
+            print("Building spell delete index...")
+            settings["max_edits"] = self._max_edits
+            save_json(self._settings_path, settings)
+            self._save_deletes(sorted(load_json(self._counter_path)))
+
+    def update_index(self):
+        manifest = DocumentManifest(self._manifest_path, self._documents_dir)
+        if not (
+            manifest.exists()
+            and os.path.exists(self._documents_path)
+            and os.path.exists(self._document_bigrams_path)
+        ):
+            print("Spell index manifest is not found, rebuilding...")
+            self.build_index()
+            self.load_index()
+            return
+
+        added, updated, removed = manifest.changes()
+        if not (added or updated or removed):
+            return
+        print(
+            f"Updating spell index: {len(added)} added, {len(updated)} updated, "
+            f"{len(removed)} removed"
+        )
+        document_counters = {
+            filename: Counter(counter)
+            for filename, counter in load_json(self._documents_path).items()
+        }
+        document_bigrams = {
+            filename: Counter(counter)
+            for filename, counter in load_json(self._document_bigrams_path).items()
+        }
+        for filename in updated + removed:
+            document_counters.pop(filename, None)
+            document_bigrams.pop(filename, None)
+        for document in read_corpus(self._documents_dir, added + updated):
+            document_counters[document.filename] = self._count_words(document)
+            document_bigrams[document.filename] = self._count_bigrams(document)
+        self._save_counters(document_counters, document_bigrams)
+        manifest.commit()
+        self.load_index()
 
     def load_index(self):
         self.settings = load_json(self._settings_path)
-        if self.save_distances and self.settings["max_edits"] != self._max_edits:
-            raise RuntimeError("'max_edits' does not match!")
         self.total_sum = self.settings["total"]
         self.words_counter = Counter(load_json(self._counter_path))
-
-        if self.save_distances:
-            self.distance_dicts = []
-            for idx in range(self._max_edits):
-                self.distance_dicts.append(
-                    load_json(os.path.join(self._spell_dir, f"distance{idx + 1}"))
-                )
+        self.words = sorted(self.words_counter)
+        # Indexes built before bigrams were counted correct words one by one
+        self.bigrams_counter = Counter(
+            load_json(self._bigrams_path) if os.path.exists(self._bigrams_path) else {}
+        )
+        if self.context and not os.path.exists(self._bigrams_path):
+            print(
+                f"Warning: spell bigrams are not found in {self._spell_dir}, context "
+                "correction falls back to word frequencies. Build them with "
+                "`uv run ./src/setup.py`"
+            )
+        if self.settings["max_edits"] != self._max_edits or not (
+            os.path.exists(self._deletes_hashes_path)
+            and os.path.exists(self._deletes_word_ids_path)
+        ):
+            raise RuntimeError(
+                f"Spell delete index for max_edits={self._max_edits} is not found in "
+                f"{self._spell_dir}, build it with `uv run ./src/setup.py`"
+            )
+        self.deletes_hashes = np.load(self._deletes_hashes_path, mmap_mode="r")
+        self.deletes_word_ids = np.load(self._deletes_word_ids_path, mmap_mode="r")
+        self.corrections.clear()
+        self.candidates.clear()
+        self.version += 1
 
     def word_probability(self, word: str) -> float:
         return self.words_counter[word] / self.total_sum
@@ -117,50 +279,118 @@ class NorvigSpellCorrector:
     def filter_known(self, words: list[str] | set[str]) -> set[str]:
         return set(w for w in words if w in self.words_counter)
 
-    def _word_candidates_saved(self, word: str) -> list[str]:
-        if self.save_distances:
-            return self._word_candidates_saved(word)
-        for i in range(self._max_edits):
-            knowns = self.distance_dicts[i].get(word, None)
-            if knowns is not None:
-                return knowns
-        return [word]
-
     def word_candidates(self, word: str) -> list[str]:
-        if self.save_distances:
-            return self._word_candidates_saved(word)
-
-        edits = {word}
-        for _ in range(self._max_edits):
-            current_edits: set[str] = set()
-            for w in edits:
-                current_edits.update(self.generate_edits(w))
-            knowns = self.filter_known(current_edits)
-            if len(knowns) > 0:
-                return list(knowns)
-            edits = current_edits
-        return [word]
+        # Known words at the smallest edit distance (up to `max_edits`) from `word`
+        hashes = np.array(
+            [hash_delete(delete) for delete in generate_deletes(word, self._max_edits)],
+            dtype=np.uint32,
+        )
+        starts = np.searchsorted(self.deletes_hashes, hashes, side="left")
+        ends = np.searchsorted(self.deletes_hashes, hashes, side="right")
+        word_ids = {
+            word_id
+            for start, end in zip(starts.tolist(), ends.tolist())
+            if start < end
+            for word_id in self.deletes_word_ids[start:end].tolist()
+        }
+
+        candidates: list[list[str]] = [[] for _ in range(self._max_edits + 1)]
+        for word_id in word_ids:
+            candidate = self.words[word_id]
+            distance = edit_distance(word, candidate, self._max_edits)
+            if distance <= self._max_edits:
+                candidates[distance].append(candidate)
+        return next((known for known in candidates if known), [word])
 
     def spell_correction_word(self, word: str) -> str:
         if word in self.words_counter:
             return word
-        return max(self.word_candidates(word), key=self.word_probability)
+        return self.corrections.get_or_compute(
+            word, lambda: max(self.word_candidates(word), key=self.word_probability)
+        )
+
+    def ranked_candidates(self, word: str) -> list[str]:
+        # Most frequent candidates first, at most `max_candidates`
+        if word in self.words_counter:
+            return [word]
+        return self.candidates.get_or_compute(
+            word,
+            lambda: sorted(
+                self.word_candidates(word), key=self.word_probability, reverse=True
+            )[: self.max_candidates],
+        )
 
-    def spell_correction(self, text: str, skip_stop_words: bool = False) -> str:
+    def _log_probability(self, word: str, previous: str | None = None) -> float:
+        # Add-one smoothed word frequency (unknown words are kept as they are),
+        # interpolated with the bigram estimate when the previous word is given
+        probability = (self.words_counter[word] + 1) / (
+            self.total_sum + len(self.words_counter)
+        )
+        if previous is not None and self.words_counter[previous]:
+            bigram = self.bigrams_counter[f"{previous} {word}"]
+            probability = (1 - self.bigram_weight) * probability + (
+                self.bigram_weight * bigram / self.words_counter[previous]
+            )
+        return math.log(probability)
+
+    def correct_sequence(self, words: list[str]) -> list[str]:
+        # Viterbi search over the candidates of each word, scored with the bigram
+        # model: the best sequence is found with `max_candidates`^2 scores per word.
+        # Known words are not changed, they only give context to their neighbours
+        if not words:
+            return []
+        lattice = [self.ranked_candidates(word) for word in words]
+        scores = {candidate: self._log_probability(candidate) for candidate in lattice[0]}
+        backpointers: list[dict[str, str]] = []
+        for candidates in lattice[1:]:
+            next_scores, pointers = {}, {}
+            for candidate in candidates:
+                previous, score = max(
+                    (
+                        (previous, score + self._log_probability(candidate, previous))
+                        for previous, score in scores.items()
+                    ),
+                    key=lambda x: x[1],
+                )
+                next_scores[candidate] = score
+                pointers[candidate] = previous
+            scores = next_scores
+            backpointers.append(pointers)
+
+        sequence = [max(scores, key=scores.__getitem__)]
+        for pointers in reversed(backpointers):
+            sequence.append(pointers[sequence[-1]])
+        return sequence[::-1]
+
+    @TIMER.timed("spell_correction")
+    def spell_correction(
+        self, text: str, skip_stop_words: bool = False, context: bool | None = None
+    ) -> str:
         tokens = self.tokenize(text.lower())
         if len(tokens) == 1:
             return self.spell_correction_word(tokens[0])
-        corrected = ""
+        words = [
+            token
+            for token in tokens
+            if token not in string.punctuation and token not in self._stop_words
+        ]
+        if self.context if context is None else context:
+            corrections = iter(self.correct_sequence(words))
+        else:
+            corrections = map(self.spell_correction_word, words)
+
+        corrected: list[str] = []
         for token in tokens:
             if token in string.punctuation:
-                if len(corrected) > 0 and corrected[-1] == " ":
-                    corrected = corrected[:-1]
-                corrected = corrected + token + " "
+                # Attached to the previous word
+                if corrected:
+                    corrected[-1] += token
+                else:
+                    corrected.append(token)
                 continue
             if token in self._stop_words:
-                if skip_stop_words:
-                    continue
-                corrected = corrected + token + " "
+                if not skip_stop_words:
+                    corrected.append(token)
                 continue
-            corrected = corrected + self.spell_correction_word(token) + " "
-        return corrected.strip()
+            corrected.append(next(corrections))
+        return " ".join(corrected)
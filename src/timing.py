@@ -0,0 +1,124 @@
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable
+
+# Upper bounds of the latency buckets, seconds. Spell correction and scoring take
+# well under a millisecond, LLM generation takes seconds
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+    0.5, 1.0, 2.5, 5.0, 10.0,
+)  # fmt: skip
+
+# [(stage, seconds)] of the request being traced, None when it is not
+_trace: contextvars.ContextVar[list[tuple[str, float]] | None] = contextvars.ContextVar(
+    "trace", default=None
+)
+
+
+# Cumulative latency histogram of one stage, as Prometheus exposes it
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> tuple[list[int], float, int]:
+        # Cumulative bucket counts, sum and count
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative, running = [], 0
+        for value in counts:
+            running += value
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+# Process-wide latency of the request stages (spell correction, expansion, scoring,
+# embedding, ...). Every span is recorded into the histogram of its stage and, when
+# the request is traced, into the trace as well
+class StageTimer:
+    metric = "stage_duration_seconds"
+
+    def __init__(self):
+        self._histograms: dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(stage, Histogram())
+        histogram.observe(seconds)
+
+        trace = _trace.get()
+        if trace is not None:
+            trace.append((stage, seconds))
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def timed(self, stage: str) -> Callable:
+        # Decorator, a span around every call
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def traced(self, func: Callable, *args, **kwargs) -> tuple[Any, dict[str, float]]:
+        # Runs `func` and returns its result with the milliseconds spent in every
+        # stage. Threads started by `func` only report into the trace if they run in
+        # a copy of its context (see `HybridSearch`)
+        trace: list[tuple[str, float]] = []
+        token = _trace.set(trace)
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            _trace.reset(token)
+        timings: dict[str, float] = {}
+        for stage, seconds in list(trace):
+            timings[stage] = timings.get(stage, 0.0) + seconds * 1e3
+        return result, timings
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines = [
+            f"# HELP {self.metric} Time spent in a stage of request processing.",
+            f"# TYPE {self.metric} histogram",
+        ]
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+        for stage, histogram in histograms:
+            cumulative, total, count = histogram.snapshot()
+            bounds = [*map(str, histogram.buckets), "+Inf"]
+            for bound, value in zip(bounds, cumulative):
+                lines.append(
+                    f'{self.metric}_bucket{{stage="{stage}",le="{bound}"}} {value}'
+                )
+            lines.append(f'{self.metric}_sum{{stage="{stage}"}} {total}')
+            lines.append(f'{self.metric}_count{{stage="{stage}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+TIMER = StageTimer()
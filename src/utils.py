@@ -3,6 +3,7 @@ import os
 import shutil
 from pathlib import Path
 
+import numpy as np
 import orjson
 
 
@@ -26,6 +27,15 @@ def save_json(path: str | Path, data: dict):
         )
 
 
+def save_array(path: str | Path, array: np.ndarray):
+    # Written aside and renamed, so readers that memory-mapped the old file keep a
+    # valid mapping while it is replaced
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(temp_path, path)
+
+
 def save(path: str, data: str):
     with open(
         path,
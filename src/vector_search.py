@@ -0,0 +1,104 @@
+import os
+import typing
+from pathlib import Path
+
+import numpy as np
+from annoy import AnnoyIndex
+from sklearn.neighbors import BallTree
+
+VectorBackend = typing.Literal["ball_tree", "exact", "annoy"]
+
+# [(row id, euclidean distance)] for every query, nearest first
+SearchResult = list[list[tuple[int, float]]]
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class BallTreeSearch:
+    def __init__(self, embeddings: np.ndarray):
+        self.tree = BallTree(embeddings, metric="euclidean")
+
+    def query(self, queries: np.ndarray, k: int) -> SearchResult:
+        k = min(k, self.tree.data.shape[0])
+        distances, indices = self.tree.query(queries, k=k)
+        return [
+            list(zip(row_indices.tolist(), row_distances.tolist()))
+            for row_indices, row_distances in zip(indices, distances)
+        ]
+
+
+class ExactSearch:
+    # Exact search over L2-normalized vectors: one BLAS matrix product for the whole
+    # batch and an `argpartition` top-k. Distances are reported as euclidean distances
+    # between normalized vectors, sqrt(2 - 2 * cos), which matches the Ball Tree
+    # distances for MiniLM (its embeddings are already unit length)
+    def __init__(self, embeddings: np.ndarray):
+        self.matrix = normalize(embeddings)
+
+    def query(self, queries: np.ndarray, k: int) -> SearchResult:
+        k = min(k, self.matrix.shape[0])
+        if k == 0:
+            return [[] for _ in range(len(queries))]
+        similarities = normalize(queries) @ self.matrix.T
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        top_similarities = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_similarities, axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        distances = np.sqrt(
+            np.maximum(2 - 2 * np.take_along_axis(top_similarities, order, axis=1), 0)
+        )
+        return [
+            list(zip(row_indices.tolist(), row_distances.tolist()))
+            for row_indices, row_distances in zip(top, distances)
+        ]
+
+
+class AnnoySearch:
+    # Approximate search with random projection trees. Angular distance in Annoy is
+    # the euclidean distance between normalized vectors, so scores are comparable
+    # with the exact backend
+    def __init__(
+        self,
+        embeddings: np.ndarray,
+        index_path: str | Path,
+        n_trees: int = 50,
+        search_k: int = -1,
+        rebuild: bool = False,
+        prefault: bool = False,
+        n_jobs: int = -1,
+        on_disk: bool = False,
+    ):
+        self.search_k = search_k
+        self.index = AnnoyIndex(embeddings.shape[1], "angular")
+
+        if rebuild or not os.path.exists(index_path):
+            # `n_jobs` threads build the trees (-1: all cores). With `on_disk` the
+            # index is built directly in its file instead of in memory and saved
+            if on_disk:
+                self.index.on_disk_build(str(index_path))
+            for i, vector in enumerate(np.asarray(embeddings, dtype=np.float32)):
+                self.index.add_item(i, vector)
+            self.index.build(n_trees, n_jobs=n_jobs)
+            if not on_disk:
+                self.index.save(str(index_path))
+        else:
+            # Memory-mapped by Annoy; `prefault` reads the whole file in upfront, so
+            # the first queries do not wait for page faults
+            self.index.load(str(index_path), prefault=prefault)
+
+    def query(self, queries: np.ndarray, k: int) -> SearchResult:
+        results: SearchResult = []
+        for query in np.asarray(queries, dtype=np.float32):
+            indices, distances = self.index.get_nns_by_vector(
+                query, k, search_k=self.search_k, include_distances=True
+            )
+            results.append(list(zip(indices, distances)))
+        return results
+
+
+VectorSearch = BallTreeSearch | ExactSearch | AnnoySearch
@@ -1,140 +1,157 @@
 import os
-import re
-import shutil
+from pathlib import Path
+from typing import Iterable
 
 import numpy as np
-from annoy import AnnoyIndex
-from gensim.models import Word2Vec
-from nltk.corpus import stopwords
-
-from src.utils import from_current_file, load_json, round_float, save_json
-
-
+from gensim.models import KeyedVectors, Word2Vec
+
+from src.ingestion import Document, read_corpus, remove_stop_words, tokenize
+from src.manifest import DocumentManifest
+from src.utils import (
+    from_current_file,
+    load_json,
+    remove_path,
+    round_float,
+    save_array,
+    save_json,
+)
+from src.vector_search import AnnoySearch
+
+
+# Cheap CPU-only semantic retriever: documents and queries are averages of Word2Vec
+# vectors of their words, searched with Annoy. Only the word vectors (`KeyedVectors`,
+# not the trainable model) are kept, and they are memory-mapped together with the
+# document vectors and the Annoy index, so loading reads no matrix upfront
 class Word2VecIndexer:
-    _stop_words = set(stopwords.words("english"))
-
     def __init__(
         self,
-        index_dir: str = "../data/embedding_directory",
-        documents_dir: str = "../data/scrapped/class_data_function__1_1",
-        top_similar: int = 10,
+        index_dir: Path = from_current_file("../data/embedding_directory"),
+        documents_dir: Path = from_current_file(
+            "../data/scrapped/class_data_function__1_1"
+        ),
         force: bool = False,
+        update: bool = False,
+        annoy_trees: int = 100,
+        annoy_jobs: int = -1,
+        annoy_on_disk: bool = False,
+        workers: int | None = None,
+        search_k: int = -1,
+        prefault: bool = False,
+        corpus: Iterable[Document] | None = None,
     ):
-        self._index_dir = from_current_file(index_dir)
-        self._documents_dir = from_current_file(documents_dir)
-        self.top_similar = top_similar
-
-        self._word2vec_model_path = os.path.join(self._index_dir, "word2vec.model")
+        self._index_dir = index_dir
+        self._documents_dir = documents_dir
+        # Build options: Annoy trees, threads building them (-1: all cores), build in
+        # the index file instead of memory, and Word2Vec training threads
+        self.annoy_trees = annoy_trees
+        self.annoy_jobs = annoy_jobs
+        self.annoy_on_disk = annoy_on_disk
+        self.workers = workers or os.cpu_count() or 1
+        # Nodes inspected per query (-1: trees * k); more is slower but more accurate
+        self.search_k = search_k
+        self.prefault = prefault
+        self.version = 0  # bumped on every (re)load, so dependent caches can expire
+
+        self._vectors_path = os.path.join(self._index_dir, "word_vectors.kv")
+        self._embeddings_path = os.path.join(self._index_dir, "doc_embeddings.npy")
         self._annoy_index_path = os.path.join(self._index_dir, "doc_embeddings.ann")
-        self.doc_embeddings: dict[int, np.ndarray] = {}  # Document ID -> embedding
-        self.annoy_index: AnnoyIndex = None  # Annoy index for document embeddings
-        self._doc_id_path = os.path.join(self._index_dir, "documents.json")
-        self.documents: dict[int, str] = {}
+        self._documents_path = os.path.join(self._index_dir, "documents.json")
+        self._manifest_path = os.path.join(self._index_dir, "manifest.json")
 
-        self.model: Word2Vec = None
+        self.documents: list[str] = []
+        self.word_vectors: KeyedVectors | None = None
+        self.doc_embeddings: np.ndarray | None = None
+        self.search: AnnoySearch | None = None
 
-        if force or not os.path.exists(self._index_dir):
+        if force or not os.path.exists(self._documents_path):
             print("Index is not found, creating new...")
-            if force:
-                try:
-                    shutil.rmtree(self._index_dir)
-                except FileNotFoundError:
-                    pass
-            os.mkdir(path=self._index_dir)
-            self.build_index()
+            remove_path(self._index_dir)
+            os.makedirs(self._index_dir, exist_ok=True)
+            self.build_index(corpus)
             print("Complete!")
+        elif update and any(
+            DocumentManifest(self._manifest_path, self._documents_dir).changes()
+        ):
+            # Word vectors depend on the whole corpus, so it is retrained
+            print("Corpus has changed, rebuilding Word2Vec index...")
+            self.build_index()
 
         self.load_index()
 
     def _tokenize(self, text: str) -> list[str]:
-        return [w for w in re.findall(r"\w+", text.lower()) if w not in self._stop_words]
-
-    def _get_similar_words(self, word: str) -> set[tuple[str, float]]:
-        matches = set()
-        if self.model and word in self.model.wv:
-            for similar_word, similarity in self.model.wv.most_similar(
-                word, topn=self.top_similar, indexer=self.annoy_indexer
-            ):
-                if similar_word in self.index:
-                    matches.add((similar_word, similarity))
-        return matches
-
-    def build_index(self):
+        return remove_stop_words(tokenize(text))
+
+    def build_index(self, corpus: Iterable[Document] | None = None):
+        # `corpus` streams the documents when several builders share one corpus pass
+        self.documents = []
         sentences = []
-        for document_id, filename in enumerate(os.listdir(self._documents_dir)):
-            if filename.endswith(".txt"):
-                with open(
-                    os.path.join(self._documents_dir, filename), "r", encoding="utf-8"
-                ) as f:
-                    text = f.read()
-                    self.documents[document_id] = filename[:-4]
-                    words = self._tokenize(text)
-                    sentences.append(words)
-
-        self.model = Word2Vec(
-            sentences=sentences,
-            min_count=1,
+        for document in (
+            corpus if corpus is not None else read_corpus(self._documents_dir)
+        ):
+            self.documents.append(document.name)
+            sentences.append(remove_stop_words(document.words))
+
+        word_vectors = Word2Vec(sentences=sentences, min_count=1, workers=self.workers).wv
+        # Vectors in their own .npy file, so they can be memory-mapped
+        word_vectors.save(self._vectors_path, separately=["vectors"])
+        self.word_vectors = word_vectors
+
+        doc_embeddings = np.vstack(
+            [self._embed(words) for words in sentences]
+            or [np.zeros((0, word_vectors.vector_size), dtype=np.float32)]
         )
-        vector_size = self.model.vector_size
-
-        self.doc_embeddings = {
-            doc_id: np.mean(
-                [self.model.wv[word] for word in words if word in self.model.wv], axis=0
-            )
-            for doc_id, words in enumerate(sentences)
-        }
-
-        # self.doc_embeddings = {}
-        # for doc_id, words in tqdm(enumerate(sentences)):
-        #     self.doc_embeddings[doc_id] = np.mean([
-        #         self.model.wv[word]
-        #         for word in words
-        #         if word in self.model.wv
-        #     ], axis=0)
-
-        # Build Annoy index for documents
-        self.annoy_index = AnnoyIndex(vector_size, "angular")
-        for doc_id, embedding in self.doc_embeddings.items():
-            self.annoy_index.add_item(doc_id, embedding)
-        self.annoy_index.build(n_trees=1000)
-        self.annoy_index.save(self._annoy_index_path)
-
-        # Persist model and index
-        self.model.save(self._word2vec_model_path)
-
-        save_json(self._doc_id_path, self.documents)
+        save_array(self._embeddings_path, doc_embeddings)
+        AnnoySearch(
+            doc_embeddings,
+            self._annoy_index_path,
+            self.annoy_trees,
+            rebuild=True,
+            n_jobs=self.annoy_jobs,
+            on_disk=self.annoy_on_disk,
+        )
+        save_json(self._documents_path, {"documents": self.documents})
+        DocumentManifest(self._manifest_path, self._documents_dir).commit()
 
     def load_index(self):
-        self.documents = {int(k): v for k, v in load_json(self._doc_id_path).items()}
-        self.model = Word2Vec.load(self._word2vec_model_path)
-        vector_size = self.model.vector_size
-        self.annoy_index = AnnoyIndex(vector_size, "angular")
-        self.annoy_index.load(self._annoy_index_path)
-
-    def find(self, query: str, top_k: int = 10) -> list:
-        query_words = self._tokenize(query)
-        query_vectors = [
-            self.model.wv[word] for word in query_words if word in self.model.wv
-        ]
-
-        if not query_vectors:
-            return []
-
-        # Average word vectors for query embedding
-        query_embedding = np.mean(query_vectors, axis=0)
-
-        # Find similar documents using Annoy
-        doc_ids, distances = self.annoy_index.get_nns_by_vector(
-            query_embedding, top_k, include_distances=True
+        self.documents = load_json(self._documents_path)["documents"]
+        self.word_vectors = KeyedVectors.load(self._vectors_path, mmap="r")
+        self.doc_embeddings = np.load(self._embeddings_path, mmap_mode="r")
+        self.search = AnnoySearch(
+            self.doc_embeddings,
+            self._annoy_index_path,
+            search_k=self.search_k,
+            prefault=self.prefault,
         )
-
-        # Convert angular distances to cosine similarities
-        results = []
-        for doc_id, distance in zip(doc_ids, distances):
-            cosine_sim = 1 - (distance**2) / 2  # Convert angular distance to cosine
-            results.append((doc_id, cosine_sim))
-
+        self.version += 1
+
+    def _embed(self, words: list[str]) -> np.ndarray:
+        # Mean of the vectors of known words, gathered with a single fancy index;
+        # zeros when there is none
+        ids = [
+            i
+            for i in map(self.word_vectors.key_to_index.get, words)  # type: ignore
+            if i is not None
+        ]
+        if not ids:
+            return np.zeros(self.word_vectors.vector_size, dtype=np.float32)  # type: ignore
+        return self.word_vectors.vectors[ids].mean(axis=0)  # type: ignore
+
+    def find(self, query: str, k: int = 10) -> list[tuple[str, float]]:
+        return self.find_many([query], k)[0]
+
+    def find_many(self, queries: list[str], k: int = 10) -> list[list[tuple[str, float]]]:
+        # Queries without known words have no results
+        embeddings = {query: self._embed(self._tokenize(query)) for query in queries}
+        searchable = [query for query, embedding in embeddings.items() if embedding.any()]
+        results = {}
+        if searchable:
+            query_embeddings = np.vstack([embeddings[query] for query in searchable])
+            results = dict(zip(searchable, self.search.query(query_embeddings, k)))  # type: ignore
+        # Angular distance to cosine similarity
         return [
-            (self.documents[doc_id], round_float(score, 5))
-            for doc_id, score in sorted(results, key=lambda x: -x[1])
+            [
+                (self.documents[doc_id], round_float(1 - distance**2 / 2, 5))
+                for doc_id, distance in results.get(query, [])
+            ]
+            for query in queries
         ]
@@ -0,0 +1,44 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class PoolOverloadedError(RuntimeError):
+    pass
+
+
+# Runs blocking calls (spell correction, fuzzy expansion, scoring, embedding forward
+# passes) outside of the event loop. At most `max_pending` calls may be running or
+# queued at once: beyond that new calls are rejected right away, so overload shows up
+# as fast errors instead of an ever-growing queue. Threads are used instead of
+# processes, so that all workers share the already loaded indexes and caches. Only
+# NumPy scoring, embedding forward passes, Annoy search and I/O release the GIL; query
+# expansion and spell correction are pure Python and run one at a time, so throughput
+# scales with cores through server processes (`SERVER_WORKERS`), not threads
+class WorkerPool:
+    def __init__(self, max_workers: int | None = None, max_pending: int | None = None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 4 * self.max_workers
+        self.pending = 0  # only touched from the event loop thread
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="worker-pool"
+        )
+
+    async def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        if self.pending >= self.max_pending:
+            raise PoolOverloadedError(
+                f"Server is busy ({self.pending} requests in progress), try again later"
+            )
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)